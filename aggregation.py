@@ -0,0 +1,82 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# strftime('%W') goes from 00 to 53
+N_WEEKS = 54
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def week_codes(timestamps: pd.Series) -> np.ndarray:
+    # Integer version of strftime('%W'): weeks start on Monday and the days before the first Monday are week 0.
+    # Missing timestamps get -1 so they are left out of the counts, just like groupby drops NaN keys.
+    values = pd.to_datetime(pd.Series(timestamps)).to_numpy(dtype='datetime64[ns]')
+    days = values.astype('datetime64[D]')
+    day_of_year = (days - values.astype('datetime64[Y]').astype('datetime64[D]')).astype(np.int64)
+    weekday = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday, Monday = 0
+    codes = (day_of_year + 7 - weekday) // 7
+    codes[np.isnat(values)] = -1
+    return codes
+
+
+def iso_week_codes(timestamps: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    # ISO year-week of every timestamp as codes into sorted 'YYYY-Www' labels, so weeks of different years never
+    # collide (and the days of a week split by new year stay together). Missing timestamps get -1.
+    iso = pd.to_datetime(pd.Series(timestamps)).dt.isocalendar()
+    keys = (iso['year'].astype('Int64') * 100 + iso['week'].astype('Int64'))
+    codes, uniques = pd.factorize(keys, sort=True)
+    return codes, pd.Index([f'{key // 100}-W{key % 100:02d}' for key in uniques], name='week')
+
+
+def count_matrix(row_codes: np.ndarray, column_codes: np.ndarray, n_rows: int, n_columns: int,
+                 weights: Optional[np.ndarray] = None) -> np.ndarray:
+    # One bincount over the flattened (row, column) cell of every observation: linear in the number of rows,
+    # whatever the size of each group.
+    row_codes, column_codes = np.asarray(row_codes, dtype=np.int64), np.asarray(column_codes, dtype=np.int64)
+    valid = (row_codes >= 0) & (column_codes >= 0)
+    cells = row_codes[valid] * n_columns + column_codes[valid]
+    if weights is None:
+        counts = np.bincount(cells, minlength=n_rows * n_columns)
+    else:
+        counts = np.rint(np.bincount(cells, weights=np.asarray(weights)[valid], minlength=n_rows * n_columns))
+    return counts.astype(np.int64).reshape(n_rows, n_columns)
+
+
+def week_labels(n_weeks: int = N_WEEKS) -> pd.Index:
+    return pd.Index([f'{week:02d}' for week in range(n_weeks)], name='week')
+
+
+def weekly_table(week_code: np.ndarray, column_codes: np.ndarray, columns: pd.Index,
+                 weights: Optional[np.ndarray] = None, active_weeks: Optional[np.ndarray] = None) -> pd.DataFrame:
+    counts = count_matrix(week_code, column_codes, N_WEEKS, len(columns), weights)
+    if active_weeks is None:
+        active_weeks = np.bincount(week_code[week_code >= 0], minlength=N_WEEKS) > 0
+    return weekly_frame(counts, columns, active_weeks)
+
+
+def weekly_frame(counts: np.ndarray, columns: pd.Index, active_weeks: np.ndarray) -> pd.DataFrame:
+    # Same shape the old pivot tables had: only weeks with orders, only columns that were ever counted
+    table = pd.DataFrame(counts, index=week_labels(), columns=columns)
+    table = table.loc[active_weeks, counts.sum(axis=0) > 0]
+    return table.sort_index(axis=1)
+
+
+def keyed_table(row_codes: np.ndarray, rows: pd.Index, column_codes: np.ndarray, columns: pd.Index,
+                weights: Optional[np.ndarray] = None) -> pd.DataFrame:
+    # Like weekly_table, for any (sorted) row keys, e.g. ISO weeks: only rows with data, only columns ever counted
+    counts = count_matrix(row_codes, column_codes, len(rows), len(columns), weights)
+    table = pd.DataFrame(counts, index=rows, columns=columns)
+    table = table.loc[np.bincount(row_codes[row_codes >= 0], minlength=len(rows)) > 0, counts.sum(axis=0) > 0]
+    return table.sort_index(axis=1)
+
+
+def add_tables(total: Optional[pd.DataFrame], partial: pd.DataFrame) -> pd.DataFrame:
+    # Merges partial weekly tables (e.g. one per chunk of orders): weeks and columns are the union of both
+    if total is None:
+        return partial
+    integers = all(pd.api.types.is_integer_dtype(dtype) for dtype in [*total.dtypes, *partial.dtypes])
+    result = total.add(partial, fill_value=0).fillna(0)
+    if integers:
+        result = result.astype(np.int64)
+    return result.sort_index().sort_index(axis=1)
@@ -0,0 +1,155 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import instrumentation
+import synthetic
+
+# The steps of the pipeline (extract, clean_dataframes, concat_dataframes, weekly_pizzas, count_ingredients,
+# predict_next_week, create_visualizations and create_excel) are timed one by one on synthetic order files of every
+# size, each one fed what the previous ones returned or stored, like in main.py.
+SIZES = [10000, 100000, 1000000]
+RESULTS_PATH = 'benchmark_results.json'
+
+
+def measure(name: str, function: Callable, *arguments, rows_in: int = 0) -> Tuple[object, dict]:
+    # Rows in and out are what the step was given and returned, or else what it read from and wrote to the store
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            instrumentation.Measurement(name) as measurement:
+        result = function(*arguments)
+    record = {'step': name, **{key: value for key, value in measurement.record.items()
+                               if key not in ['stage', 'started', 'status', 'pid']}}
+    record['rows_in'] = rows_in or record['rows_in']
+    record['rows_out'] = instrumentation.rows(result) or record['rows_out']
+    return result, record
+
+
+def run_steps(workers: Optional[int] = None) -> List[dict]:
+    # The pipeline of main.py on the data/ of the current directory, step by step. Writing the store between the
+    # steps is not timed
+    import catalog
+    import excel
+    import main
+    import report
+    import store
+
+    records = []
+
+    def step(name: str, function: Callable, *arguments, rows_in: int = 0):
+        result, record = measure(name, function, *arguments, rows_in=rows_in)
+        records.append(record)
+        return result
+
+    description, dataframe_container = step('extract', main.extract)
+    raw_rows = instrumentation.rows(dataframe_container)
+    frames = step('clean_dataframes', main.clean_dataframes, dataframe_container, rows_in=raw_rows)
+    menu = catalog.build(frames[2], frames[3])
+    dataframe_pd, order_lines = step('concat_dataframes', main.concat_dataframes, description, frames, menu,
+                                     rows_in=instrumentation.rows(frames))
+    store.save('catalog', menu)
+    store.save('clean_dataframe', dataframe_pd)
+    store.save('order_lines', order_lines)
+
+    weeks = step('weekly_pizzas', main.weekly_pizzas, order_lines, True, rows_in=len(order_lines))
+    store.save('pizzas_weeks_types', weeks)
+    store.save('pizzas_weeks_sizes', main.weekly_pizzas(order_lines, False))
+    total_count, weeks_ingredients = step('count_ingredients', main.count_ingredients, order_lines, menu, frames[3],
+                                          rows_in=len(order_lines))
+    store.save('ingredients_weeks', weeks_ingredients)
+    main.stage_cube(None)
+
+    forecasts = step('predict_next_week', main.predict_next_week, weeks_ingredients, order_lines['Timestamp'],
+                     rows_in=len(weeks_ingredients))
+    store.save('forecasts', forecasts)
+    step('create_visualizations', report.create_visualizations, workers, rows_in=len(order_lines))
+    step('create_excel', excel.create_excel, rows_in=len(order_lines) + len(dataframe_pd))
+    return records
+
+
+def benchmark(lines: int, seed: int = 0, workers: Optional[int] = None, keep: bool = False) -> dict:
+    # Generates the synthetic files in a scratch directory and runs the steps there, with empty caches
+    data_directory = os.path.abspath('data')
+    directory = tempfile.mkdtemp(prefix=f'benchmark_{lines}_')
+    current = os.getcwd()
+    try:
+        start = time.perf_counter()
+        generated = synthetic.generate(directory, lines, seed, menu_directory=data_directory)
+        generate_seconds = time.perf_counter() - start
+        for name in ['processed_data', 'images']:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        os.chdir(directory)
+        steps = run_steps(workers)
+    finally:
+        os.chdir(current)
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {'lines': generated['lines'], 'orders': generated['orders'], 'seed': seed,
+            'generate_seconds': round(generate_seconds, 4), 'directory': directory if keep else None, 'steps': steps}
+
+
+def environment() -> dict:
+    import numpy as np
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+            'processors': os.cpu_count()}
+
+
+def summary(results: dict, baseline: Optional[dict] = None) -> pd.DataFrame:
+    # Seconds and peak memory of every step and size, and how many times faster than the baseline run
+    table = pd.DataFrame([{'lines': run['lines'], **step} for run in results['runs'] for step in run['steps']])
+    table = table.set_index(['lines', 'step'])[['seconds', 'cpu_seconds', 'peak_rss_mb', 'rows_in', 'rows_out']]
+    if baseline is not None:
+        before = pd.DataFrame([{'lines': run['lines'], **step} for run in baseline['runs'] for step in run['steps']])
+        before = before.set_index(['lines', 'step'])['seconds'].reindex(table.index)
+        table['baseline_seconds'] = before
+        table['speedup'] = (before / table['seconds']).round(2)
+    return table
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Time and peak memory of every step of the pipeline on synthetic "
+                                                 "data of several sizes")
+    parser.add_argument('--lines', type=int, nargs='+', default=SIZES, help="order lines of each run")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="processes rendering the charts (1, the default, keeps them in the measured process)")
+    parser.add_argument('--output', default=RESULTS_PATH, help="json file to write the results to")
+    parser.add_argument('--compare', default=None, metavar='JSON', help="results of a previous run to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the generated data and outputs of every run")
+    arguments = parser.parse_args(argv)
+
+    results: Dict[str, object] = {'environment': environment(), 'runs': []}
+    for lines in arguments.lines:
+        print(f"Benchmarking {lines} order lines...", flush=True)
+        results['runs'].append(benchmark(lines, arguments.seed, arguments.jobs, arguments.keep))
+        # Written after every size, so a run that fails or runs out of memory keeps the previous ones
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    baseline = None
+    if arguments.compare is not None:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None):
+        print(summary(results, baseline))
+    print(f"Results written to {arguments.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# The menu indexed once by pizza_id (sorted), with the type, size and category of every pizza as categorical codes and
+# its price. Joining pizza ids to their metadata, or splitting them into type and size, is then a lookup of the row of
+# each distinct id and array indexing, instead of merges and string parsing of every order line.
+KEYS = ['pizza_type_id', 'size', 'category']
+
+
+def build(pizzas: pd.DataFrame, pizza_types: pd.DataFrame) -> pd.DataFrame:
+    menu = pizzas[['pizza_id', 'pizza_type_id', 'size', 'price']].drop_duplicates('pizza_id')
+    menu = menu.astype({'pizza_id': str, 'pizza_type_id': str, 'size': str})
+    categories = pizza_types.drop_duplicates('pizza_type_id').set_index('pizza_type_id')['category']
+    menu['category'] = categories.reindex(menu['pizza_type_id']).to_numpy()
+    menu = menu.set_index('pizza_id').sort_index()
+    for column in KEYS:
+        menu[column] = menu[column].astype('category')
+    return menu[KEYS + ['price']]
+
+
+def rows(catalog: pd.DataFrame, pizza_ids: Iterable) -> np.ndarray:
+    # Row of every pizza id in the catalog (-1 for ids not on the menu). Only the distinct ids are looked up
+    pizza_ids = pizza_ids if isinstance(pizza_ids, pd.Series) else pd.Series(pizza_ids)
+    if isinstance(pizza_ids.dtype, pd.CategoricalDtype):
+        codes, uniques = pizza_ids.cat.codes.to_numpy(), pizza_ids.cat.categories
+    else:
+        codes, uniques = pd.factorize(pizza_ids)
+    found = catalog.index.get_indexer(pd.Index(uniques).astype(str))
+    return np.where(codes >= 0, found[codes], -1)
+
+
+def take(catalog: pd.DataFrame, column: str, positions: np.ndarray, observed: bool = True):
+    # The column of the catalog at the given rows (missing for -1). Categorical columns stay categorical, with only
+    # the categories that appear unless observed is False
+    values = catalog[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()[positions]
+        codes[positions < 0] = -1
+        result = pd.Categorical.from_codes(codes, values.cat.categories)
+        return result.remove_unused_categories() if observed else result
+    return np.where(positions >= 0, values.to_numpy(dtype=float)[positions], np.nan)
+
+
+def lookup(catalog: pd.DataFrame, pizza_ids: Iterable, columns: List[str] = None) -> pd.DataFrame:
+    # The catalog columns of every pizza id, indexed by the ids
+    positions = rows(catalog, pizza_ids)
+    return pd.DataFrame({column: take(catalog, column, positions) for column in columns or list(catalog.columns)},
+                        index=pd.Index(pizza_ids, name='pizza_id'))
@@ -0,0 +1,86 @@
+import hashlib
+import inspect
+import os
+import shutil
+import time
+from typing import Callable, Optional
+
+import matplotlib
+import pandas as pd
+import seaborn as sns
+
+import outputs
+
+# Rendered charts, named after a hash of everything that goes into them: the data they plot and the code (with its
+# styling) that draws them. A chart whose hash is already here is copied instead of being drawn again.
+CACHE_DIRECTORY = 'images/cache'
+MAX_CACHE_BYTES = 64 << 20
+MAX_CACHE_AGE = 30 * 24 * 60 * 60
+
+
+def update_digest(digest, value) -> None:
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(type(value).__name__.encode())
+        digest.update(repr((value.shape, list(value.index.names),
+                            list(value.columns) if isinstance(value, pd.DataFrame) else value.name,
+                            value.dtypes.astype(str).tolist() if isinstance(value, pd.DataFrame)
+                            else str(value.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            update_digest(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def key(render: Callable, arguments: tuple) -> str:
+    digest = hashlib.sha1()
+    # The source of the render function holds the styling parameters, the library versions how they look
+    digest.update(inspect.getsource(render).encode())
+    digest.update(f'{matplotlib.__version__} {sns.__version__} {pd.__version__}'.encode())
+    # The output path is not part of the chart
+    update_digest(digest, arguments[:-1])
+    return digest.hexdigest()
+
+
+def path(chart_key: str) -> str:
+    return os.path.join(CACHE_DIRECTORY, f'{chart_key}.png')
+
+
+def fetch(chart_key: str, destination: str) -> bool:
+    cached = path(chart_key)
+    if not os.path.exists(cached):
+        return False
+    with outputs.atomic_path(destination) as temporary:
+        shutil.copyfile(cached, temporary)
+    # Used entries stay fresh, eviction goes by the last time they were used
+    os.utime(cached)
+    return True
+
+
+def put(chart_key: str, source: str) -> None:
+    with outputs.atomic_path(path(chart_key)) as temporary:
+        shutil.copyfile(source, temporary)
+
+
+def evict(max_bytes: int = MAX_CACHE_BYTES, max_age: Optional[float] = MAX_CACHE_AGE) -> int:
+    # Drops the entries not used in max_age seconds and then the least recently used ones until the cache fits in
+    # max_bytes. Returns how many were dropped
+    if not os.path.isdir(CACHE_DIRECTORY):
+        return 0
+    entries = []
+    for file_name in os.listdir(CACHE_DIRECTORY):
+        # (hidden files are entries being written)
+        if file_name.endswith('.png') and not file_name.startswith('.'):
+            stat = os.stat(os.path.join(CACHE_DIRECTORY, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+    entries.sort(reverse=True)
+
+    now, total, evicted = time.time(), 0, 0
+    for modified, size, file_name in entries:
+        total += size
+        if (max_age is not None and now - modified > max_age) or total > max_bytes:
+            os.remove(os.path.join(CACHE_DIRECTORY, file_name))
+            total -= size
+            evicted += 1
+    return evicted
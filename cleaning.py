@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+import outputs
+
+# Typos found in the raw pizza ids, and the separators that must become underscores
+PIZZA_TYPOS = str.maketrans({'@': 'a', '0': 'o', '3': 'e'})
+PIZZA_SEPARATORS = r"-|\s+"
+
+# Formats found in orders.csv, tried in this order, and whatever none of them matches falls back to the element-wise
+# dateutil parser. The ones it reads give the same result it gave (e.g. '04-03-16' is month first, '15-01-16' can
+# only be day first). It could not read the others at all ('18:58 PM', a 24 hour clock with AM/PM, '21H 28M 27S' and
+# dates as seconds since 1970), so those rows used to be filled from the previous order instead.
+EPOCH = 'epoch'
+DATE_FORMATS = ['%Y-%m-%d', '%b %d %Y', '%a %d-%b-%Y', '%A,%d %B, %Y', '%m-%d-%y %H:%M:%S', '%d-%m-%y %H:%M:%S',
+                EPOCH]
+TIME_FORMATS = ['%H:%M:%S', '%I:%M %p', '%H:%M %p', '%HH %MM %SS']
+
+# Raw pizza id -> catalog pizza id, kept between runs
+PIZZA_ID_CACHE = 'processed_data/pizza_id_cache.json'
+MAX_CACHED_PIZZA_IDS = 50000
+
+
+def reformat_pizza_ids(pizza_ids: pd.Series) -> pd.Series:
+    return pizza_ids.str.translate(PIZZA_TYPOS).str.replace(PIZZA_SEPARATORS, '_', regex=True)
+
+
+class PizzaIdNormalizer:
+    # Bounded (least recently used first out) memo of raw pizza_id -> canonical pizza_id. Raw ids that cannot be
+    # resolved to a pizza of the catalog are memoized as None, so they are rejected without being recomputed.
+    def __init__(self, catalog: Iterable[str], path: str = PIZZA_ID_CACHE, max_size: int = MAX_CACHED_PIZZA_IDS):
+        self.catalog = pd.Index(sorted(set(catalog)))
+        self.path = path
+        self.max_size = max_size
+        self.checksum = hashlib.sha1('\n'.join(self.catalog).encode('utf-8')).hexdigest()
+        self.cache = OrderedDict()
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            stored = json.load(file)
+        # A cache built against another menu may map to ids that do not exist anymore
+        if stored.get('catalog') == self.checksum:
+            self.cache.update(stored['pizza_ids'])
+
+    def save(self):
+        if self.path is None:
+            return
+        with outputs.atomic(self.path, encoding='utf-8') as file:
+            json.dump({'catalog': self.checksum, 'pizza_ids': self.cache}, file)
+
+    def normalize(self, pizza_ids: pd.Series) -> Tuple[pd.Series, pd.DataFrame]:
+        codes, uniques = pd.factorize(pizza_ids)
+        uniques = pd.Series(uniques, dtype=object)
+
+        # Only raw ids never seen before go through the string reformatting, then get validated
+        misses = uniques[~uniques.isin(list(self.cache))]
+        resolved = reformat_pizza_ids(misses)
+        valid = resolved.isin(self.catalog)
+        self.cache.update((raw_id, pizza_id if known else None)
+                          for raw_id, pizza_id, known in zip(misses, resolved, valid))
+        for raw_id in uniques:
+            self.cache.move_to_end(raw_id)
+        # Mapped before anything is evicted, and only older ids are: the ids of this batch are all at the end, and the
+        # memo may hold more than max_size of them when a batch has that many distinct ids
+        mapped = uniques.map(self.cache)
+        while len(self.cache) > max(self.max_size, len(uniques)):
+            self.cache.popitem(last=False)
+        result = pd.Series(mapped.to_numpy(dtype=object)[codes], index=pizza_ids.index, name=pizza_ids.name)
+        result[codes < 0] = np.nan
+
+        # Raw ids not matching any pizza of the catalog, and how many rows had them
+        rejected = mapped.isna().to_numpy()
+        rows = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        rejects = pd.DataFrame({'raw_pizza_id': uniques[rejected], 'rows': rows[rejected]})
+        return result, rejects.sort_values('rows', ascending=False, ignore_index=True)
+
+
+def parse_quantities(quantities: pd.Series) -> pd.Series:
+    # Only plain digit strings are valid quantities ('one', '-1', ... become NaN and are filled afterwards)
+    quantities = quantities.astype(str)
+    return pd.to_numeric(quantities.where(quantities.str.isdigit()), errors='coerce')
+
+
+def parse_epoch_dates(values: pd.Series) -> pd.Series:
+    # Seconds since 1970 ('1478386800.0') of the midnight a date starts at, in the timezone of the shop, so rounded to
+    # the nearest day (normalizing would give the day before for a timezone ahead of UTC)
+    seconds = pd.to_numeric(values.where(values.str.fullmatch(r'\d+(\.\d*)?')), errors='coerce')
+    return pd.to_datetime(seconds, unit='s', errors='coerce').dt.round('D')
+
+
+def parse_datetimes(values: pd.Series, formats: List[str]) -> Tuple[pd.Series, pd.Series]:
+    # Every distinct string is parsed once, column-wide per format; rows only index into the parsed uniques
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    matched = np.full(len(uniques), -1)
+
+    pending = uniques.index
+    for position, date_format in enumerate(formats):
+        if pending.empty:
+            break
+        if date_format == EPOCH:
+            attempt = parse_epoch_dates(uniques[pending])
+        else:
+            attempt = pd.to_datetime(uniques[pending], format=date_format, errors='coerce')
+        hits = attempt.index[attempt.notna()]
+        parsed[hits], matched[hits] = attempt[hits], position
+        pending = pending.difference(hits)
+
+    if not pending.empty:
+        parsed[pending] = pd.to_datetime(uniques[pending], errors='coerce')
+        matched[pending] = len(formats)
+
+    # How many rows each format accounted for
+    labels = formats + ['fallback', 'missing']
+    rows = np.where(codes >= 0, matched[codes], len(formats) + 1)
+    report = pd.Series(np.bincount(rows, minlength=len(labels)), index=pd.Index(labels, name='format'), name='rows')
+    result = pd.Series(parsed.to_numpy()[codes], index=values.index, name=values.name)
+    result[codes < 0] = pd.NaT
+    return result, report
@@ -0,0 +1,127 @@
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import catalog
+import recipes
+
+# Pre-aggregated orders: one row per (day, hour) for the orders, and per (day, hour, pizza) for the pizzas, with
+# integer time keys. Any rollup (hourly, weekly, monthly... by pizza type, size or category) is then a group by over
+# these cells, which are much fewer than the order lines, instead of regrouping the raw orders by timestamp strings.
+TIME_KEYS = ['hour', 'day', 'weekday', 'week', 'month', 'year']
+PIZZA_KEYS = ['pizza_id', 'pizza_type_id', 'size', 'category']
+
+
+def time_cells(timestamps: pd.Series) -> pd.DataFrame:
+    values = pd.to_datetime(pd.Series(timestamps)).to_numpy(dtype='datetime64[ns]')
+    valid = ~np.isnat(values)
+    days = values.astype('datetime64[D]').astype(np.int64)
+    hours = (values.astype('datetime64[h]').astype(np.int64) - days * 24)
+    return pd.DataFrame({'day': np.where(valid, days, -1), 'hour': np.where(valid, hours, -1)},
+                        index=pd.Series(timestamps).index)
+
+
+def build_orders(clean_dataframe: pd.DataFrame) -> pd.DataFrame:
+    # orders, pizzas and revenue of every (day, hour) with orders
+    cells = time_cells(clean_dataframe['Timestamp'])
+    cells['orders'] = 1
+    cells['pizzas'] = clean_dataframe['Amount_ordered'].to_numpy(dtype=np.int64)
+    cells['revenue'] = clean_dataframe['Price'].to_numpy()
+    cells = cells[cells['day'] >= 0]
+    return cells.groupby(['day', 'hour'], as_index=False)[['orders', 'pizzas', 'revenue']].sum()
+
+
+def build_pizzas(order_lines: pd.DataFrame, menu: pd.DataFrame) -> pd.DataFrame:
+    # pizzas and revenue of every (day, hour, pizza) with orders, with the type, size and category of the pizza from
+    # its row of the catalog
+    cells = time_cells(order_lines['Timestamp'])
+    cells['row'] = catalog.rows(menu, order_lines['pizza_id'])
+    cells['pizzas'] = order_lines['quantity'].to_numpy(dtype=np.int64)
+    cells['revenue'] = order_lines['revenue'].to_numpy()
+    cells = cells[cells['day'] >= 0]
+    cells = cells.groupby(['day', 'hour', 'row'], as_index=False)[['pizzas', 'revenue']].sum()
+    rows = cells.pop('row').to_numpy()
+    cells['pizza_id'] = pd.Categorical.from_codes(rows, menu.index).remove_unused_categories()
+    for column in catalog.KEYS:
+        cells[column] = catalog.take(menu, column, rows)
+    return cells[['day', 'hour'] + PIZZA_KEYS + ['pizzas', 'revenue']]
+
+
+def merge(cubes: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    # Cubes of different parts of the orders (e.g. stored in parts, or different stores) added up cell by cell
+    cubes = list(cubes)
+    measures = [column for column in cubes[0].columns if column not in ['day', 'hour'] + PIZZA_KEYS]
+    keys = [column for column in cubes[0].columns if column not in measures]
+    cube = pd.concat(cubes, ignore_index=True)
+    merged = cube.groupby(keys, as_index=False, observed=True)[measures].sum()
+    for column in keys:
+        if column in PIZZA_KEYS:
+            merged[column] = merged[column].astype('category')
+    return merged
+
+
+def span(cube: pd.DataFrame) -> pd.Series:
+    # First and last hour with orders, as timestamps: all the holiday and partial week adjustments of the forecasts
+    # need to know of the orders, without loading them
+    hours = cube['day'].to_numpy(dtype=np.int64) * 24 + cube['hour'].to_numpy(dtype=np.int64)
+    hours = hours[cube['day'].to_numpy() >= 0]
+    return pd.Series(pd.to_datetime(np.array([hours.min(), hours.max()]) * 3600, unit='s'), name='Timestamp')
+
+
+def day_number(date) -> int:
+    return int(pd.Timestamp(date).to_datetime64().astype('datetime64[D]').astype(np.int64))
+
+
+def time_key(cube: pd.DataFrame, key: str) -> np.ndarray:
+    if key not in TIME_KEYS:
+        raise ValueError(f"Unknown time key '{key}', expected one of {', '.join(TIME_KEYS)}")
+    days = cube['day'].to_numpy()
+    if key == 'hour':
+        return cube['hour'].to_numpy()
+    if key == 'day':
+        return days
+    if key == 'weekday':
+        return (days + 3) % 7  # 1970-01-01 was a Thursday, Monday = 0
+    dates = days.astype('datetime64[D]')
+    if key == 'week':
+        return aggregation.week_codes(pd.Series(dates.astype('datetime64[ns]')))
+    if key == 'month':
+        return dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    return dates.astype('datetime64[Y]').astype(np.int64) + 1970
+
+
+def query(cube: pd.DataFrame, time: Union[str, List[str], None] = None, by: Optional[str] = None,
+          measure: Union[str, List[str]] = 'pizzas', start: Optional[str] = None,
+          end: Optional[str] = None) -> Union[pd.DataFrame, pd.Series]:
+    # Rollup of the measure(s) by the time key(s) (rows) and, optionally, a pizza key (columns), for the days between
+    # start and end (both included, any date pandas can parse)
+    if start is not None or end is not None:
+        days = cube['day'].to_numpy()
+        first = -np.inf if start is None else day_number(start)
+        last = np.inf if end is None else day_number(end)
+        cube = cube[(days >= first) & (days <= last)]
+    times = [] if time is None else [time] if isinstance(time, str) else time
+    keys = [pd.Series(time_key(cube, key), index=cube.index, name=key) for key in times]
+    if by is not None:
+        keys.append(cube[by])
+    if not keys:
+        return cube[measure].sum()
+    # (sorted explicitly: with observed=True categorical keys come out in order of appearance)
+    result = cube.groupby(keys, observed=True)[measure].sum().sort_index()
+    if by is not None and times:
+        result = result.unstack(by, fill_value=0)
+        result.columns = result.columns.astype(str)
+        result = result.sort_index(axis=1)
+    return result
+
+
+def ingredients(cube: pd.DataFrame, pizza_types: pd.DataFrame, time: Union[str, List[str]] = 'week',
+                start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+    # Ingredients used by time bucket: the pizzas rollup times the recipes
+    table = query(cube, time, 'pizza_id', 'pizzas', start, end)
+    pizzas = cube[['pizza_id', 'pizza_type_id', 'size']].astype(str).drop_duplicates('pizza_id')
+    pizzas = pizzas.set_index('pizza_id').reindex(table.columns)
+    matrix, types, names = recipes.recipe_matrix(pizza_types)
+    return recipes.consumption(table, recipes.pizza_recipe_matrix(matrix, types, pizzas), names)
@@ -0,0 +1,86 @@
+import glob
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+
+# A step of the pipeline: what it needs to run before it, the files it reads besides their outputs, and the files it
+# writes (glob patterns, so a frame stored in parts is a single output)
+class Stage(NamedTuple):
+    name: str
+    run: Callable[..., None]
+    dependencies: List[str]
+    inputs: List[str]
+    outputs: List[str]
+
+
+def modified(pattern: str) -> Optional[float]:
+    # Last time any of the files matching the pattern was written (None if there is none)
+    times = [os.path.getmtime(file_name) for file_name in glob.glob(pattern)]
+    return max(times) if times else None
+
+
+def stale(stage: Stage, stages: Dict[str, Stage]) -> bool:
+    # Like make: some output is missing, or older than some input (the outputs of its dependencies included)
+    outputs = [modified(pattern) for pattern in stage.outputs]
+    if not outputs or None in outputs:
+        return True
+    inputs = [modified(pattern) for pattern in stage.inputs +
+              [output for dependency in stage.dependencies for output in stages[dependency].outputs]]
+    inputs = [time for time in inputs if time is not None]
+    return bool(inputs) and max(inputs) > min(outputs)
+
+
+def plan(stages: List[Stage], targets: Iterable[str], force: bool = False, done: Iterable[str] = ()) -> List[str]:
+    # Stages to run, in dependency order: the targets and whatever they depend on that is stale. Forced targets run
+    # anyway, and the stages in done are taken as up to date (their outputs were just written some other way)
+    stages = {stage.name: stage for stage in stages}
+    targets, done = set(targets), set(done)
+    unknown = targets - set(stages)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    order, runs, visiting = [], {}, set()
+
+    def visit(name: str) -> bool:
+        if name in runs:
+            return runs[name]
+        if name in visiting:
+            raise ValueError(f"Stage '{name}' depends on itself")
+        visiting.add(name)
+        # Every dependency is visited, so none of the stale ones is left behind
+        dependencies_run = [visit(dependency) for dependency in stages[name].dependencies]
+        visiting.remove(name)
+        runs[name] = name not in done and ((force and name in targets) or any(dependencies_run) or
+                                           stale(stages[name], stages))
+        if runs[name]:
+            order.append(name)
+        return runs[name]
+
+    for target in sorted(targets):
+        visit(target)
+    return order
+
+
+def run(stages: List[Stage], targets: Iterable[str], arguments=None, force: bool = False, done: Iterable[str] = (),
+        workers: Optional[int] = None) -> List[str]:
+    # Runs the planned stages, each one as soon as its dependencies finished, so the independent ones (e.g. the pdf
+    # report and the excel workbook) run at the same time in different processes. Returns the stages that ran
+    order = plan(stages, targets, force, done)
+    stages = {stage.name: stage for stage in stages}
+    if workers == 1 or len(order) <= 1:
+        for name in order:
+            stages[name].run(arguments)
+        return order
+
+    pending, running, finished = list(order), {}, set(stages) - set(order)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name in [name for name in pending if finished.issuperset(stages[name].dependencies)]:
+                pending.remove(name)
+                running[pool.submit(stages[name].run, arguments)] = name
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                # A failed stage stops the pipeline (the ones already running are waited for)
+                future.result()
+                finished.add(running.pop(future))
+    return order
@@ -1,35 +1,95 @@
 import os
+from typing import Iterable, List, Optional
+
 import pandas as pd
+import xlsxwriter
+
+import aggregation
+import catalog
+import cube
+import outputs
+import store
+
+# Rows are written in chunks straight to the file (xlsxwriter's constant memory mode), so the per order sheets do not
+# need the whole workbook in memory. Sheets longer than what Excel can hold go on in new sheets.
+CHUNK_ROWS = 10000
+MAX_SHEET_ROWS = 1048575
+DATETIME_FORMAT = 'mmm d yyyy hh:mm:ss'
+EXCEL_PATH = 'report_maven_excel.xlsx'
+
+
+def sheet_names(sheet_name: str) -> Iterable[str]:
+    yield sheet_name
+    part = 2
+    while True:
+        suffix = f' ({part})'
+        yield sheet_name[:31 - len(suffix)] + suffix
+        part += 1
+
+
+def write_frames(workbook: xlsxwriter.Workbook, sheet_name: str, frames: Iterable[pd.DataFrame], index: bool = True,
+                 widths: Optional[dict] = None, max_rows: int = MAX_SHEET_ROWS) -> List[str]:
+    # Writes the frames (e.g. the parts of a stored frame) one after another, row by row, with a header on every sheet.
+    # Values keep their types: numbers, datetimes and text, and missing values are left blank. Returns the sheets used
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    names, used, header, row = sheet_names(sheet_name), [], [], max_rows
 
+    def add_sheet():
+        worksheet = workbook.add_worksheet(name := next(names))
+        used.append(name)
+        for column, width in (widths or {}).items():
+            worksheet.set_column(column, column, width)
+        worksheet.write_row(0, 0, ['' if column is None else column for column in header], header_format)
+        return worksheet
 
-def create_excel():
+    for frame in frames:
+        header = (list(frame.index.names) if index else []) + list(frame.columns)
+        if index:
+            frame = frame.reset_index(names=[f'level_{level}' for level in range(frame.index.nlevels)])
+        for start in range(0, len(frame.index), CHUNK_ROWS):
+            chunk = frame.iloc[start:start + CHUNK_ROWS]
+            for values in chunk.astype(object).where(chunk.notna(), None).to_numpy().tolist():
+                if row >= max_rows:
+                    worksheet, row = add_sheet(), 0
+                row += 1
+                worksheet.write_row(row, 0, values)
+    if not used:
+        # No rows at all: just the header
+        add_sheet()
+    return used
+
+
+def create_excel(details: bool = True, max_rows: int = MAX_SHEET_ROWS):
+    # Built under a temporary name and renamed once closed, so a half written workbook is never opened
+    with outputs.atomic_path(EXCEL_PATH) as path:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'default_date_format': DATETIME_FORMAT})
+        write_workbook(workbook, details, max_rows)
+        workbook.close()
+
+
+def write_workbook(workbook: xlsxwriter.Workbook, details: bool, max_rows: int):
     # Cannot be read via loop because of how dockerfile saves these files
-    clean_dataframe = pd.read_csv("processed_data/clean_dataframe.csv", encoding='latin')
-    ingredients_weeks = pd.read_csv("processed_data/ingredients_weeks.csv", encoding='latin')
-    pizzas_weeks_sizes = pd.read_csv("processed_data/pizzas_weeks(with sizes).csv", encoding='latin')
-    pizzas_weeks = pd.read_csv("processed_data/pizzas_weeks(with types_only).csv", encoding='latin')
-    
-    clean_dataframe.set_index('order_id', inplace=True)
-    ingredients_weeks.set_index('week', inplace=True)
-    pizzas_weeks_sizes.set_index('week', inplace=True)
-    pizzas_weeks.set_index('week', inplace=True)
-
-    writer = pd.ExcelWriter("report_maven_excel.xlsx",  engine="xlsxwriter", datetime_format='mmm d yyyy hh:mm:ss')
-
-    # Sheet 1
-    clean_dataframe['Timestamp'] = pd.to_datetime(clean_dataframe['Timestamp'], format='%Y-%m-%d %H:%M:%S')
-    clean_dataframe.to_excel(writer, sheet_name="Orders, Timestamp and Details")
-    worksheet = writer.sheets["Orders, Timestamp and Details"]
-    worksheet.set_column(1, 1, 20)
-    worksheet.set_column(2, 2, 20)
-    worksheet.set_column(3, 3, 20)
+    ingredients_weeks = store.load('ingredients_weeks')
+    pizzas_weeks_sizes = store.load('pizzas_weeks_sizes')
+    pizzas_weeks = store.load('pizzas_weeks_types')
+    cube_orders = store.load('cube_orders')
+    menu = store.load('catalog')
+
+    if details:
+        # Sheet 1: streamed from the stored parts, never the whole frame at once
+        write_frames(workbook, "Orders, Timestamp and Details", store.parts('clean_dataframe'),
+                     widths={1: 20, 2: 20, 3: 20}, max_rows=max_rows)
+
+        # Sheet 1 (details): one row per ordered pizza line instead of a list of pizzas per order
+        write_frames(workbook, "Order Lines", store.parts('order_lines'), index=False,
+                     widths={1: 15, 2: 15, 5: 20}, max_rows=max_rows)
 
     # Sheet 2
-    months = clean_dataframe[['Timestamp', 'Amount_ordered', 'Price']]
-    months = months.groupby(months['Timestamp'].dt.month)[['Amount_ordered', 'Price']].sum()
-    months.to_excel(writer, sheet_name="Orders, Month and Details")
-    worksheet = writer.sheets["Orders, Month and Details"]
-    chart = writer.book.add_chart({'type': 'line'})
+    months = cube.query(cube_orders, 'month', measure=['pizzas', 'revenue'])
+    months.columns = ['Amount_ordered', 'Price']
+    months.index.name = 'Timestamp'
+    worksheet = workbook.get_worksheet_by_name(write_frames(workbook, "Orders, Month and Details", [months])[0])
+    chart = workbook.add_chart({'type': 'line'})
     chart.add_series({'values': f'=\'Orders, Month and Details\'!$C$2:$C$'
                                 f'{(columns := months.shape[0] + 1)}',
                       'categories': f'=\'Orders, Month and Details\'!$A$2:$A${columns}',
@@ -38,17 +98,24 @@ def create_excel():
     chart.set_style(36)
     worksheet.insert_chart('G2', chart, {'x_scale': 3, 'y_scale': 2})
 
+    # Sheet 2 (load): orders per hour of each day of the week, for staffing the peaks
+    hours = cube.query(cube_orders, ['weekday', 'hour'], measure='orders').unstack('hour', fill_value=0)
+    hours.index = pd.Index(aggregation.WEEKDAYS, name='Weekday')[hours.index]
+    worksheet = workbook.get_worksheet_by_name(write_frames(workbook, "Orders per Hour", [hours], widths={0: 12})[0])
+    worksheet.conditional_format(1, 1, hours.shape[0], hours.shape[1], {'type': '3_color_scale'})
+
     # Sheet 3
     pizzas_sizes_sum = pizzas_weeks_sizes.sum(axis=0).to_frame(name="Amount")
     pizzas_sizes_sum['Size'] = pizzas_sizes_sum.index
     pizzas_sizes_sum.reset_index(inplace=True)
-    pizzas_sizes_sum['Pizza'] = pizzas_sizes_sum['Size'].apply(lambda pizza: pizza.rsplit('_', 1)[0])
-    pizzas_sizes_sum['Size'] = pizzas_sizes_sum['Size'].apply(lambda pizza: pizza.rsplit('_', 1)[1].upper())
+    pizzas = catalog.lookup(menu, pizzas_sizes_sum['Size'], ['pizza_type_id', 'size'])
+    pizzas_sizes_sum['Pizza'] = pizzas['pizza_type_id'].astype(str).to_numpy()
+    pizzas_sizes_sum['Size'] = pizzas['size'].astype(str).str.upper().to_numpy()
     pizzas_sizes_sum.sort_values('Pizza', ascending=True, inplace=True)
     # Create sheet
-    pizzas_sizes_sum.to_excel(writer, sheet_name="Amount of Pizzas with Sizes")
-    worksheet = writer.sheets["Amount of Pizzas with Sizes"]
-    chart = writer.book.add_chart({'type': 'column'})
+    worksheet = workbook.get_worksheet_by_name(write_frames(workbook, "Amount of Pizzas with Sizes",
+                                                            [pizzas_sizes_sum])[0])
+    chart = workbook.add_chart({'type': 'column'})
     chart.add_series({'values': f'=\'Amount of Pizzas with Sizes\'!$C$2:$C$'
                                 f'{(columns := pizzas_sizes_sum.shape[0] + 1)}',
                       'categories': f'=\'Amount of Pizzas with Sizes\'!$B$2:$B${columns}',
@@ -57,9 +124,8 @@ def create_excel():
     chart.set_style(37)
     worksheet.insert_chart('G2', chart, {'x_scale': 3, 'y_scale': 2})
 
-    # Sheet 4
-    pizzas_weeks.T.to_excel(writer, sheet_name="Amount of Pizzas per Week")
+    # Sheet 4 (the week labels of the tables are '00', '01', ..., the sheets keep the week numbers)
+    write_frames(workbook, "Amount of Pizzas per Week", [pizzas_weeks.T.rename(columns=int)])
 
     # Sheet 5
-    ingredients_weeks.T.to_excel(writer, sheet_name="Amount of Ingredients per Week")
-    writer.close()
+    write_frames(workbook, "Amount of Ingredients per Week", [ingredients_weeks.T.rename(columns=int)])
@@ -0,0 +1,138 @@
+import warnings
+from typing import Callable, Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+import aggregation
+
+# Every method turns a (weeks x columns) array into the one-step-ahead forecasts of all its columns for every cut-off
+# at once: row t is what the method predicts for week t knowing only the weeks before it (row 0 is NaN, the last row
+# is the forecast for the week after the data). So a backtest over the whole history is a single array operation.
+ROLLING_WINDOW = 4
+SMOOTHING = 0.3
+# Cut-offs with less history than this are not scored
+MIN_HISTORY = 8
+
+
+def shifted(values: np.ndarray) -> np.ndarray:
+    # values with a row of NaN on top: row t holds what is known right after week t - 1
+    return np.vstack([np.full((1,) + values.shape[1:], np.nan), values.astype(float)])
+
+
+def ignoring_empty(statistic: Callable, windows: np.ndarray) -> np.ndarray:
+    # Windows with no weeks at all (the first cut-off) are NaN, without a warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return statistic(windows, axis=-1)
+
+
+def expanding(values: np.ndarray, statistic: str) -> np.ndarray:
+    # statistic ('median' or 'mean') of all the weeks before every cut-off. pandas updates it week by week (a sorted
+    # skiplist for the median, running sums for the mean), so memory stays linear in the weeks, unlike windows over
+    # the whole history. Missing weeks are skipped
+    frame = pd.DataFrame(values.reshape(len(values), -1).astype(float))
+    result = getattr(frame.expanding(min_periods=1), statistic)().to_numpy()
+    return shifted(result.reshape(values.shape))
+
+
+def rolling(values: np.ndarray, statistic: Callable, window: int = ROLLING_WINDOW) -> np.ndarray:
+    # statistic of the last window weeks before every cut-off (of all of them while there are fewer)
+    padded = np.vstack([np.full((window,) + values.shape[1:], np.nan), values.astype(float)])
+    windows = sliding_window_view(padded, window, axis=0)
+    return ignoring_empty(statistic, windows)
+
+
+def exponential_smoothing(values: np.ndarray, alpha: float = SMOOTHING) -> np.ndarray:
+    # Simple exponential smoothing, level_t = alpha * y_t + (1 - alpha) * level_t-1 starting at y_0, as a linear
+    # filter over the time axis of all columns (scipy.signal takes most of a second to import, so only when needed)
+    from scipy.signal import lfilter
+    values = values.astype(float)
+    levels = lfilter([alpha], [1, alpha - 1], values, axis=0, zi=(1 - alpha) * values[:1])[0]
+    return shifted(levels)
+
+
+METHODS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    'median': lambda values: expanding(values, 'median'),
+    'mean': lambda values: expanding(values, 'mean'),
+    'rolling_median': lambda values: rolling(values, np.nanmedian),
+    'rolling_mean': lambda values: rolling(values, np.nanmean),
+    'exponential_smoothing': exponential_smoothing,
+}
+
+
+def one_step_forecasts(table: pd.DataFrame, methods: Iterable[str] = None) -> Dict[str, np.ndarray]:
+    values = table.to_numpy()
+    return {method: METHODS[method](values) for method in (methods or METHODS)}
+
+
+def backtest(table: pd.DataFrame, forecasts: Optional[Dict[str, np.ndarray]] = None,
+             min_history: int = MIN_HISTORY) -> pd.DataFrame:
+    # Mean absolute error of every method and column over all the cut-offs with enough history (methods x columns)
+    forecasts = one_step_forecasts(table) if forecasts is None else forecasts
+    actual = table.to_numpy(dtype=float)[min_history:]
+    return pd.DataFrame({method: ignoring_empty(np.nanmean, np.abs(predicted[min_history:-1] - actual).T)
+                         for method, predicted in forecasts.items()}, index=table.columns).T
+
+
+def holiday_weeks(timestamps: pd.Series) -> pd.Index:
+    # Labels of the weeks (of the weekly tables) with a US federal holiday
+    timestamps = pd.to_datetime(pd.Series(timestamps)).dropna()
+    holidays = USFederalHolidayCalendar().holidays(timestamps.min().normalize(), timestamps.max())
+    return aggregation.week_labels()[np.unique(aggregation.week_codes(pd.Series(holidays)))]
+
+
+def partial_weeks(timestamps: pd.Series) -> pd.Index:
+    # Labels of the first and last weeks if the data starts after their Monday or ends before their Sunday
+    timestamps = pd.to_datetime(pd.Series(timestamps)).dropna()
+    first, last = timestamps.min(), timestamps.max()
+    codes = aggregation.week_codes(pd.Series([first, last]))[[first.dayofweek != 0, last.dayofweek != 6]]
+    return aggregation.week_labels()[np.unique(codes)]
+
+
+def holiday_factors(table: pd.DataFrame, weeks: pd.Index, partial: pd.Index = None) -> pd.Series:
+    # How much more (or less) of every column goes in a week with a holiday than in a normal one. Partial weeks
+    # would look like slow ones, so they are left out
+    table = table if partial is None else table[~table.index.isin(partial)]
+    holiday = table.index.isin(weeks)
+    if not holiday.any() or holiday.all():
+        return pd.Series(1.0, index=table.columns)
+    factors = table[holiday].mean(axis=0) / table[~holiday].mean(axis=0)
+    return factors.replace([np.inf, -np.inf], np.nan).fillna(1.0)
+
+
+def next_week_has_holiday(timestamps: pd.Series) -> bool:
+    last = pd.to_datetime(pd.Series(timestamps)).max().normalize()
+    monday = last + pd.Timedelta(days=7 - last.dayofweek)
+    return len(USFederalHolidayCalendar().holidays(monday, monday + pd.Timedelta(days=6))) > 0
+
+
+def weekday_shares(weekday_table: pd.DataFrame) -> pd.DataFrame:
+    # Share of the weekly amount of every column that goes in each day of the week (7 x columns)
+    totals = weekday_table.sum(axis=0).replace(0, np.nan)
+    return (weekday_table / totals).fillna(1 / 7)
+
+
+def forecast(table: pd.DataFrame, timestamps: Optional[pd.Series] = None,
+             min_history: int = MIN_HISTORY) -> pd.DataFrame:
+    # Next week forecast of every column with every method, the method with the lowest backtest error for each column
+    # and its forecast (Amount), adjusted for holidays when the timestamps of the orders are given
+    forecasts = one_step_forecasts(table)
+    errors = backtest(table, forecasts, min_history)
+    result = pd.DataFrame({method: predicted[-1] for method, predicted in forecasts.items()}, index=table.columns)
+    if errors.notna().any().any():
+        best = errors.fillna(np.inf).idxmin(axis=0)
+    else:
+        # Not enough history to compare the methods: the median is the safest bet
+        best = pd.Series('median', index=table.columns)
+    result['method'] = best
+    result['error'] = errors.to_numpy()[errors.index.get_indexer(best), np.arange(len(best))]
+    result['Amount'] = result.to_numpy()[np.arange(len(best)), result.columns.get_indexer(best)].astype(float)
+    if timestamps is not None:
+        result['holiday_factor'] = holiday_factors(table, holiday_weeks(timestamps), partial_weeks(timestamps))
+        if next_week_has_holiday(timestamps):
+            result['Amount'] *= result['holiday_factor']
+    result['Amount'] = result['Amount'].round(1)
+    return result
@@ -0,0 +1,56 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+# Libraries only the pdf report, the excel workbook and the interactive visualizations need, which the headless
+# data path must not load
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'dataframe_image', 'fpdf', 'plotly', 'IPython', 'requests', 'xlsxwriter']
+BUDGET = 1.0
+
+PROBE = '''
+import sys
+import time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(','.join(name for name in {heavy!r} if name in sys.modules))
+'''
+
+
+def measure(module: str = 'main', runs: int = 5) -> Tuple[List[float], List[str], List[float]]:
+    # Every run imports the module in a fresh interpreter, so nothing is already cached in sys.modules
+    import_times, process_times, loaded = [], [], set()
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True).stdout.splitlines()
+        process_times.append(time.perf_counter() - start)
+        import_times.append(float(output[0]))
+        loaded.update(name for name in (output[1].split(',') if len(output) > 1 else []) if name)
+    return import_times, sorted(loaded), process_times
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Import time of the headless data path")
+    parser.add_argument('--module', default='main', help="module to import")
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters to import it in")
+    parser.add_argument('--budget', type=float, default=BUDGET, help="maximum median import time, in seconds")
+    arguments = parser.parse_args(argv)
+
+    import_times, loaded, process_times = measure(arguments.module, arguments.runs)
+    median = statistics.median(import_times)
+    print(f"import {arguments.module}: median {median:.3f}s, min {min(import_times):.3f}s, "
+          f"max {max(import_times):.3f}s (interpreter start included: {statistics.median(process_times):.3f}s)")
+    if loaded:
+        print(f"Heavy modules loaded at import: {', '.join(loaded)}")
+    if loaded or median > arguments.budget:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
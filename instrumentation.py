@@ -0,0 +1,187 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+# Wall time, CPU time, peak memory and rows read and written of every stage of a run, appended as one json line per
+# stage to the run log. Optionally, a cProfile of the stage (saved for pstats/snakeviz) and its top allocations
+# (tracemalloc). Nothing is measured unless a run id is given, so uninstrumented runs only pay for a None check.
+RUN_LOG = 'processed_data/run_log.jsonl'
+PROFILE_DIRECTORY = 'processed_data/profiles'
+PROFILERS = ['cprofile', 'tracemalloc']
+TOP_ALLOCATIONS = 10
+# Resident memory is sampled this often while a stage runs
+SAMPLE_INTERVAL = 0.005
+
+# Measurement of the stage running in this process, which the store and extract report their rows to
+current: Optional['Measurement'] = None
+
+
+def resident_bytes() -> int:
+    # Current resident set size of this process (Linux), or the peak so far where /proc is not available
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class PeakMemory:
+    # Highest resident memory seen while the block runs, sampled from a background thread
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, resident_bytes())
+
+    def __enter__(self) -> 'PeakMemory':
+        self.start = self.peak = resident_bytes()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, resident_bytes())
+
+
+def rows(value) -> int:
+    # Rows of a frame, or of all the frames in a container
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value.index)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(rows(item) for item in value)
+    return 0
+
+
+def rows_read(value) -> None:
+    if current is not None:
+        current.rows_in += rows(value)
+
+
+def rows_written(value) -> None:
+    if current is not None:
+        current.rows_out += rows(value)
+
+
+class Measurement:
+    def __init__(self, name: str, profilers: Iterable[str] = ()):
+        self.name = name
+        self.profilers = list(profilers)
+        self.rows_in = self.rows_out = 0
+        self.record = {}
+        self.previous = None
+
+    def __enter__(self) -> 'Measurement':
+        global current
+        self.previous, current = current, self
+        self.memory = PeakMemory().__enter__()
+        self.profile = cProfile.Profile() if 'cprofile' in self.profilers else None
+        if 'tracemalloc' in self.profilers:
+            tracemalloc.start()
+        self.started = time.time()
+        self.start, self.cpu_start = time.perf_counter(), time.process_time()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback) -> None:
+        global current
+        if self.profile is not None:
+            self.profile.disable()
+        seconds, cpu_seconds = time.perf_counter() - self.start, time.process_time() - self.cpu_start
+        self.memory.__exit__()
+        current = self.previous
+        self.record = {'stage': self.name, 'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                       'status': 'ok' if exception_type is None else 'failed', 'pid': os.getpid(),
+                       'seconds': round(seconds, 4), 'cpu_seconds': round(cpu_seconds, 4),
+                       'peak_rss_mb': round(self.memory.peak / 2 ** 20, 1),
+                       'peak_rss_increase_mb': round((self.memory.peak - self.memory.start) / 2 ** 20, 1),
+                       'rows_in': self.rows_in, 'rows_out': self.rows_out}
+        if self.profile is not None:
+            os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+            self.profile.dump_stats(profile_path := os.path.join(PROFILE_DIRECTORY, f'{self.name}.prof'))
+            self.record['cprofile'] = profile_path
+        if 'tracemalloc' in self.profilers:
+            snapshot = tracemalloc.take_snapshot()
+            self.record['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+            self.record['top_allocations'] = [
+                {'location': f'{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}',
+                 'size_mb': round(statistic.size / 2 ** 20, 2), 'blocks': statistic.count}
+                for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+
+
+def new_run_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+def write(record: dict, run_id: str, path: str = RUN_LOG) -> None:
+    # One short append per stage, so stages finishing at the same time in different processes do not mix their lines
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        file.write(json.dumps({'run': run_id, **record}) + '\n')
+
+
+def read(run_id: str, path: str = RUN_LOG) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [record for record in map(json.loads, file) if record['run'] == run_id]
+
+
+@contextlib.contextmanager
+def logged(name: str, run_id: Optional[str], profilers: Iterable[str] = ()) -> Iterator[Optional[Measurement]]:
+    # Measures the block as a stage of the run and logs it, failed or not. Does nothing without a run id
+    if run_id is None:
+        yield None
+        return
+    measurement = Measurement(name, profilers)
+    try:
+        with measurement:
+            yield measurement
+    finally:
+        write(measurement.record, run_id)
+
+
+class Instrumented:
+    # Stage function that measures and logs itself. Picklable, so it can run in the worker processes of dag.run
+    def __init__(self, name: str, run, run_id: str, profilers: Iterable[str] = ()):
+        self.name = name
+        self.run = run
+        self.run_id = run_id
+        self.profilers = list(profilers)
+
+    def __call__(self, arguments) -> None:
+        with logged(self.name, self.run_id, self.profilers):
+            self.run(arguments)
+
+
+def instrument(stages: list, run_id: Optional[str], profilers: Iterable[str] = ()) -> list:
+    if run_id is None:
+        return stages
+    return [stage._replace(run=Instrumented(stage.name, stage.run, run_id, profilers)) for stage in stages]
+
+
+def summary(records: List[dict]) -> pd.DataFrame:
+    # One row per stage of the run, in the order they finished, and the total
+    table = pd.DataFrame(records, columns=['stage', 'status', 'seconds', 'cpu_seconds', 'peak_rss_mb', 'rows_in',
+                                           'rows_out']).set_index('stage')
+    if not table.empty:
+        table.loc['total'] = ['', table['seconds'].sum(), table['cpu_seconds'].sum(), table['peak_rss_mb'].max(),
+                              table['rows_in'].sum(), table['rows_out'].sum()]
+    return table
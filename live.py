@@ -0,0 +1,313 @@
+import argparse
+import hashlib
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import catalog
+import cleaning
+import recipes
+
+# Running counts over a feed of order lines (e.g. a point of sale), one line at a time or in batches, in constant
+# memory: nothing of the lines is kept once they are counted. Pizzas of the menu, a bounded set, are counted exactly by
+# week of every year, so the weekly pizza and ingredient tables of a year come out exactly as weekly_pizzas and
+# count_ingredients give them for the lines of that year. Raw pizza ids as they come (typos, new spellings, garbage)
+# are open ended, so they only go into a Count-Min sketch (how many pizzas were ordered with any given raw id, never
+# underestimated) and a Space-Saving summary of the most frequent ones.
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+HEAVY_HITTERS = 64
+PIZZAS_PATH = 'data/pizzas.csv'
+PIZZA_TYPES_PATH = 'data/pizza_types.csv'
+# Snapshot tables are stored under these names
+SNAPSHOTS = {'types': 'live_pizzas_weeks_types', 'sizes': 'live_pizzas_weeks_sizes',
+             'ingredients': 'live_ingredients_weeks', 'raw_ids': 'live_raw_pizza_ids'}
+
+
+def hashes(keys: Iterable) -> np.ndarray:
+    # Stable 64 bit hash of every key (as text), the same in every process, so sketches can be saved and merged
+    return np.array([int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'little')
+                     for key in keys], dtype=np.uint64)
+
+
+class CountMinSketch:
+    # depth rows of width counters. A key adds its count to one counter per row, and its estimate is the smallest of
+    # them: never below the true count, and above it by at most e / width of the total with probability
+    # 1 - exp(-depth)
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH):
+        self.width, self.depth = width, depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def columns(self, keys: Iterable) -> np.ndarray:
+        # Counter of every key in every row, from two halves of a single 64 bit hash (double hashing)
+        values = hashes(keys)
+        first, second = values & np.uint64(0xFFFFFFFF), (values >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((first[None, :] + rows * second[None, :]) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, keys: Iterable, counts: Iterable[int]) -> None:
+        counts = np.asarray(list(counts), dtype=np.int64)
+        # Flat position of every (row, counter), added at once even where keys collide
+        cells = self.columns(keys) + (np.arange(self.depth) * self.width)[:, None]
+        np.add.at(self.table.reshape(-1), cells.reshape(-1), np.tile(counts, self.depth))
+        self.total += int(counts.sum())
+
+    def estimate(self, keys: Iterable) -> np.ndarray:
+        columns = self.columns(keys)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other: 'CountMinSketch') -> None:
+        # Sketches of different feeds with the same width and depth add up counter by counter
+        self.table += other.table
+        self.total += other.total
+
+
+class SpaceSaving:
+    # The (at most) capacity most frequent keys. A new key takes the place of the least counted one and inherits its
+    # count as a possible overestimate (error), so every key counted more than total / capacity times is kept
+    def __init__(self, capacity: int = HEAVY_HITTERS):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, key: str, count: int = 1) -> None:
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            smallest = min(self.counts, key=self.counts.get)
+            error = self.counts.pop(smallest)
+            del self.errors[smallest]
+        self.counts[key], self.errors[key] = error + count, error
+
+    def top(self, k: Optional[int] = None) -> pd.DataFrame:
+        table = pd.DataFrame({'count': pd.Series(self.counts, dtype=np.int64),
+                              'error': pd.Series(self.errors, dtype=np.int64)})
+        table.index.name = 'raw_pizza_id'
+        table = table.sort_values(['count', 'error'], ascending=[False, True], kind='stable')
+        return table if k is None else table.head(k)
+
+
+def week_code(timestamp: pd.Timestamp) -> int:
+    # Scalar version of aggregation.week_codes
+    return int(timestamp.strftime('%W'))
+
+
+def split_years(timestamps: pd.Series) -> Iterable[Tuple[int, np.ndarray]]:
+    # Every year of the timestamps, with the positions of its lines. The weeks of the tables ('%W') start over every
+    # year, so each year gets its own counts
+    years = timestamps.dt.year.to_numpy()
+    for year in pd.unique(years):
+        yield int(year), np.flatnonzero(years == year)
+
+
+def quantity(value) -> Optional[int]:
+    # Scalar version of cleaning.parse_quantities: only plain digit strings (or numbers) are valid
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return int(value) if value >= 0 else None
+    text = str(value)
+    return int(text) if text.isdigit() else None
+
+
+class LiveCounts:
+    # Lines are filled like clean_frames fills the files, in the order they arrive: a missing timestamp, or a missing
+    # or invalid pizza id or quantity, is taken from the last line that had one (lines before any valid one are left
+    # out, there is nothing before them to fill them with)
+    def __init__(self, menu: pd.DataFrame, pizza_types: pd.DataFrame, width: int = SKETCH_WIDTH,
+                 depth: int = SKETCH_DEPTH, heavy_hitters: int = HEAVY_HITTERS):
+        self.menu = menu
+        self.pizza_types = pizza_types
+        # Only kept in memory, the memo is bounded
+        self.normalizer = cleaning.PizzaIdNormalizer(menu.index, path=None)
+        self.rows = {pizza_id: row for row, pizza_id in enumerate(menu.index)}
+        # year -> weeks x pizzas
+        self.counts: Dict[int, np.ndarray] = {}
+        self.sketch = CountMinSketch(width, depth)
+        self.heavy_hitters = SpaceSaving(heavy_hitters)
+        self.lines = self.skipped = 0
+        # Last valid value of every column, and the year and week of the last line counted
+        self.carry: Dict[str, object] = {'timestamp': None, 'row': None, 'quantity': None}
+        self.year: Optional[int] = None
+        self.week: Optional[int] = None
+
+    def year_counts(self, year: Optional[int] = None) -> np.ndarray:
+        # Counts of a year (by default the year of the last line counted), all zero for a year without lines
+        year = self.year if year is None else year
+        if year not in self.counts:
+            empty = np.zeros((aggregation.N_WEEKS, len(self.menu)), dtype=np.int64)
+            if year is None:
+                return empty
+            self.counts[year] = empty
+        return self.counts[year]
+
+    def resolve(self, pizza_id) -> Optional[int]:
+        # Row of the menu of a raw pizza id, through the memo of the normalizer
+        if pizza_id not in self.normalizer.cache:
+            self.normalizer.normalize(pd.Series([pizza_id], dtype=object))
+        self.normalizer.cache.move_to_end(pizza_id)
+        canonical = self.normalizer.cache[pizza_id]
+        return None if canonical is None else self.rows[canonical]
+
+    def add(self, timestamp, pizza_id, amount=1) -> None:
+        # One order line
+        missing_id = pizza_id is None or pizza_id != pizza_id
+        row = None if missing_id else self.resolve(pizza_id)
+        count = None if amount is None or amount != amount else quantity(amount)
+        parsed = pd.NaT if timestamp is None else pd.to_datetime(timestamp, errors='coerce')
+        if pd.notna(parsed):
+            self.carry['timestamp'] = pd.Timestamp(parsed)
+        if row is not None:
+            self.carry['row'] = row
+        if count is not None:
+            self.carry['quantity'] = count
+        self.lines += 1
+        if None in self.carry.values():
+            self.skipped += 1
+            return
+        self.year, self.week = self.carry['timestamp'].year, week_code(self.carry['timestamp'])
+        self.year_counts()[self.week, self.carry['row']] += self.carry['quantity']
+        if not missing_id:
+            self.sketch.add([pizza_id], [self.carry['quantity']])
+            self.heavy_hitters.add(str(pizza_id), self.carry['quantity'])
+
+    def update(self, lines: pd.DataFrame) -> None:
+        # A batch of lines (Timestamp, pizza_id and quantity columns), counted like they were added one by one
+        timestamps = pd.to_datetime(lines['Timestamp'], errors='coerce')
+        canonical, _ = self.normalizer.normalize(lines['pizza_id'].astype(object))
+        rows = pd.Series(pd.Index(self.menu.index).get_indexer(canonical.fillna('')), index=lines.index,
+                         dtype=np.float64).where(lambda values: values >= 0)
+        counts = cleaning.parse_quantities(lines['quantity'])
+        filled = pd.DataFrame({'timestamp': timestamps, 'row': rows, 'quantity': counts}).ffill()
+        for column, last in self.carry.items():
+            if last is not None:
+                filled[column] = filled[column].fillna(last)
+        valid = filled.notna().all(axis=1).to_numpy()
+        self.lines += len(lines)
+        self.skipped += int((~valid).sum())
+        for column in self.carry:
+            values = filled[column].dropna()
+            if not values.empty:
+                last = values.iloc[-1]
+                self.carry[column] = pd.Timestamp(last) if column == 'timestamp' else int(last)
+        if not valid.any():
+            return
+        filled = filled[valid]
+        weeks = aggregation.week_codes(filled['timestamp'])
+        pizzas = filled['row'].to_numpy(dtype=np.int64)
+        amounts = filled['quantity'].to_numpy(dtype=np.int64)
+        for year, positions in split_years(filled['timestamp']):
+            counts = self.year_counts(year)
+            counts += aggregation.count_matrix(weeks[positions], pizzas[positions], aggregation.N_WEEKS,
+                                               len(self.menu), amounts[positions])
+        self.year, self.week = int(filled['timestamp'].iloc[-1].year), int(weeks[-1])
+
+        # The sketches get the raw ids as they came, with the pizzas of their line
+        raw = pd.DataFrame({'raw': lines['pizza_id'].to_numpy(dtype=object)[valid], 'amount': amounts})
+        raw = raw[raw['raw'].notna()]
+        raw = raw.groupby(raw['raw'].astype(str), sort=False)['amount'].sum()
+        if not raw.empty:
+            self.sketch.add(raw.index, raw.to_numpy())
+            for key, amount in raw.items():
+                self.heavy_hitters.add(key, int(amount))
+
+    def weekly_pizzas(self, types_only: bool = False, year: Optional[int] = None) -> pd.DataFrame:
+        # Same table weekly_pizzas gives for the lines of a year counted so far, by default the year of the last one
+        counts = self.year_counts(year)
+        active_weeks = counts.sum(axis=1) > 0
+        if not types_only:
+            return aggregation.weekly_frame(counts, pd.Index(self.menu.index.astype(str), name='Pizzas'),
+                                            active_weeks)
+        # pizza x pizza type, with a 1 for the type of every pizza
+        types = self.menu['pizza_type_id'].cat
+        membership = (types.codes.to_numpy()[:, None] == np.arange(len(types.categories))).astype(np.int64)
+        return aggregation.weekly_frame(counts @ membership, pd.Index(types.categories.astype(str), name='Pizzas'),
+                                        active_weeks)
+
+    def count_ingredients(self, size_multipliers: Optional[Dict[str, float]] = None, year: Optional[int] = None) -> \
+            Tuple[pd.Series, pd.DataFrame]:
+        # Same as count_ingredients for the lines of a year counted so far, by default the year of the last one
+        table = self.weekly_pizzas(types_only=False, year=year)
+        pizzas = catalog.lookup(self.menu, table.columns, ['pizza_type_id', 'size'])
+        matrix, types, ingredients = recipes.recipe_matrix(self.pizza_types)
+        weeks_ingredients = recipes.consumption(table, recipes.pizza_recipe_matrix(matrix, types, pizzas,
+                                                                                  size_multipliers), ingredients)
+        total_count = weeks_ingredients.sum(axis=0)
+        total_count.name = "Total_Count"
+        total_count.index.name = "Ingredients"
+        return total_count, weeks_ingredients
+
+    def week_ingredients(self, week: Optional[int] = None, year: Optional[int] = None) -> pd.Series:
+        # Ingredients used so far in a week, by default the week (and year) of the last line counted
+        week = self.week if week is None else week
+        weeks_ingredients = self.count_ingredients(year=year)[1]
+        label = f'{week:02d}' if week is not None else None
+        if label not in weeks_ingredients.index:
+            return pd.Series(0, index=weeks_ingredients.columns, name=label, dtype=np.int64)
+        return weeks_ingredients.loc[label]
+
+    def top_pizzas(self, k: int = 10, types_only: bool = False, year: Optional[int] = None) -> pd.Series:
+        # Exact: pizzas (or pizza types) ordered so far in a year, most ordered first
+        totals = self.weekly_pizzas(types_only, year).sum(axis=0)
+        return totals.sort_values(ascending=False, kind='stable').head(k).rename('Amount')
+
+    def top_raw_ids(self, k: int = 10) -> pd.DataFrame:
+        # Approximate: the most frequent raw ids, with their Count-Min estimate and whether they are on the menu
+        table = self.heavy_hitters.top(k)
+        table['estimate'] = self.sketch.estimate(table.index) if len(table) else []
+        table['pizza_id'] = self.normalizer.normalize(pd.Series(table.index, dtype=object))[0].to_numpy()
+        return table
+
+    def estimate(self, raw_pizza_id: str) -> int:
+        # Pizzas ordered so far with this exact raw id (never less than the true count)
+        return int(self.sketch.estimate([raw_pizza_id])[0])
+
+
+def load_menu(pizzas_path: str = PIZZAS_PATH, pizza_types_path: str = PIZZA_TYPES_PATH) -> \
+        Tuple[pd.DataFrame, pd.DataFrame]:
+    pizza_types = pd.read_csv(pizza_types_path, delimiter=',', encoding='latin')
+    return catalog.build(pd.read_csv(pizzas_path, delimiter=',', encoding='latin'), pizza_types), pizza_types
+
+
+def snapshot(counts: LiveCounts) -> None:
+    # The running tables of the current year into the store, with the shapes of the batch ones
+    import store
+    store.save(SNAPSHOTS['types'], counts.weekly_pizzas(types_only=True))
+    store.save(SNAPSHOTS['sizes'], counts.weekly_pizzas(types_only=False))
+    store.save(SNAPSHOTS['ingredients'], counts.count_ingredients()[1])
+    store.save(SNAPSHOTS['raw_ids'], counts.top_raw_ids(counts.heavy_hitters.capacity))
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Running weekly pizza and ingredient counts over a feed of order "
+                                                 "lines read from stdin, one 'timestamp;pizza_id;quantity' per line")
+    parser.add_argument('--snapshot-every', type=int, default=1000, metavar='LINES',
+                        help="store the running tables every this many lines (and at the end)")
+    parser.add_argument('--top', type=int, default=10, help="pizzas and raw ids shown at every snapshot")
+    arguments = parser.parse_args(argv)
+
+    menu, pizza_types = load_menu()
+    counts = LiveCounts(menu, pizza_types)
+
+    def report():
+        snapshot(counts)
+        print(f"{counts.lines} lines ({counts.skipped} skipped), week {counts.week} of {counts.year}:")
+        print(counts.top_pizzas(arguments.top, types_only=True).to_string())
+        print(counts.top_raw_ids(arguments.top).to_string(), flush=True)
+
+    for number, line in enumerate(sys.stdin, start=1):
+        fields = (line.rstrip('\r\n').split(';') + ['', '', ''])[:3]
+        timestamp, pizza_id, amount = (field if field != '' else None for field in fields)
+        counts.add(timestamp, pizza_id, amount)
+        if number % arguments.snapshot_every == 0:
+            report()
+    report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
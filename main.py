@@ -1,14 +1,27 @@
+import argparse
+import io
 import os
-import re
 import sys
-from typing import List, Tuple
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
-from IPython.display import display
 
-import excel
-import report
+import aggregation
+import catalog
+import cleaning
+import cube
+import dag
+import forecasting
+import instrumentation
+import manifest
+import outputs
+import profiling
+import recipes
+import store
 from xml.etree.ElementTree import Element, SubElement, Comment, tostring
 from xml.dom.minidom import parseString
 
@@ -18,6 +31,15 @@ pd.set_option('display.width', 1000000)
 pd.set_option('display.colheader_justify', 'center')
 pd.set_option('display.precision', 3)
 
+DIRTY_COLUMNS = ['date', 'time', 'pizza_id', 'quantity']
+# Ids are read straight into int32, half the memory of the default int64
+ID_COLUMNS = ['order_id', 'order_details_id']
+ORDERS_READ_OPTIONS = {'delimiter': ';', 'encoding': 'cp1252',
+                       'dtype': {**{column: str for column in DIRTY_COLUMNS},
+                                 **{column: np.int32 for column in ID_COLUMNS}}}
+ORDERS_KEYS = {"orders.csv": ['order_id'], "order_details.csv": ['order_id', 'order_details_id']}
+REJECTS_PATH = "processed_data/pizza_id_rejects.csv"
+
 
 class DescribedDataFrame(pd.DataFrame):
     # normal properties
@@ -28,7 +50,7 @@ class DescribedDataFrame(pd.DataFrame):
         return DescribedDataFrame
 
 
-def extract() -> Tuple[pd.Series, List[DescribedDataFrame]]:
+def extract(chunksize: Optional[int] = None, orders: bool = True) -> Tuple[pd.Series, Dict[str, DescribedDataFrame]]:
     dataframe_container = {}
     temp = pd.read_csv('data/data_dictionary.csv', encoding='latin')
     description = pd.Series(data=list(temp['Description']), index=temp['Field'])
@@ -36,11 +58,20 @@ def extract() -> Tuple[pd.Series, List[DescribedDataFrame]]:
     for csv_name in os.listdir("data/"):
         if not csv_name == "data_dictionary.csv" and csv_name.endswith('.csv'):
             if csv_name == "orders.csv" or csv_name == "order_details.csv":
-                dataframe = DescribedDataFrame(pd.read_csv('data/' + csv_name, delimiter=';', encoding='cp1252'))
+                if not orders:
+                    continue
+                # Dirty columns are always read as text, so every chunk is parsed the same way
+                options = ORDERS_READ_OPTIONS
+                if chunksize is not None:
+                    # Streaming mode: the two big files are handed over as chunk readers
+                    dataframe_container[csv_name] = pd.read_csv('data/' + csv_name, chunksize=chunksize, **options)
+                    continue
+                dataframe = DescribedDataFrame(pd.read_csv('data/' + csv_name, **options))
             else:
                 dataframe = DescribedDataFrame(pd.read_csv('data/' + csv_name, delimiter=',', encoding='latin'))
             dataframe.name = csv_name.split('.csv')[0]
             dataframe_container[csv_name] = dataframe
+            instrumentation.rows_read(dataframe)
     return description, dataframe_container
 
 
@@ -50,121 +81,387 @@ def clean_dataframes(dataframe_container: List[DescribedDataFrame]) -> List[Desc
                                                  dataframe_container["pizzas.csv"],\
                                                  dataframe_container["pizza_types.csv"]
 
+    normalizer = cleaning.PizzaIdNormalizer(pizzas['pizza_id'])
+    dataframe_container, rejects, formats_report = clean_frames([orders, order_details, pizzas, pizza_types],
+                                                                normalizer)
+    normalizer.save()
+    report_rejects(sum_rejects([rejects]))
+    print("Rows matched by each date/time format:")
+    display(formats_report)
+    return dataframe_container
+
+
+def clean_frames(dataframe_container: List[DescribedDataFrame], normalizer: cleaning.PizzaIdNormalizer) -> \
+        Tuple[List[DescribedDataFrame], pd.DataFrame, pd.Series]:
+    orders, order_details, pizzas, pizza_types = dataframe_container
+
     # Sorting dataframes for filling nan's afterwards...
     orders.sort_values(by='order_id', ascending=True, ignore_index=True, inplace=True)
     order_details.sort_values(by=['order_id', 'order_details_id'], ascending=True, ignore_index=True, inplace=True)
 
-    def change_quantities(quantity):
-        return int(quantity) if (isinstance(quantity, str) and quantity.isdigit()) else float('nan')
-
-    def reformat_pizzas(pizza):
-        if isinstance(pizza, float):
-            return pizza
-        for char, initial in {'@': 'a', '0': 'o', '3': 'e'}.items():
-            pizza = pizza.replace(char, initial)
-        return re.sub(r"-|\s+", '_', pizza)
-
     # Reformatting the pizzas with their specified syntax and quantities
-    order_details['quantity'] = order_details['quantity'].apply(change_quantities)
-    order_details['pizza_id'] = order_details['pizza_id'].apply(reformat_pizzas)
+    order_details, rejects = clean_order_details(order_details, normalizer)
     order_details = order_details.ffill(axis=0).bfill(axis=0)
 
     # Reformatting dates and times
-    orders['date'] = pd.to_datetime(orders['date'], errors='coerce').dt.strftime('%d/%m/%Y')
-    orders['time'] = pd.to_datetime(orders['time'], errors='coerce').dt.strftime('%H:%M:%S')
+    orders, formats_report = clean_orders(orders)
     orders = orders.ffill(axis=0).bfill(axis=0)
-    return [orders, order_details, pizzas, pizza_types]
+    return [orders, order_details, pizzas, pizza_types], rejects, formats_report
 
 
-def concat_dataframes(description: pd.Series, dataframe_container: List[DescribedDataFrame]) -> DescribedDataFrame:
-    orders, order_details, pizzas, pizza_types = dataframe_container
+# Row-wise cleaning steps: they don't depend on the neighbouring rows, so they can run on any chunk of the files
+def clean_order_details(order_details: DescribedDataFrame, normalizer: cleaning.PizzaIdNormalizer) -> \
+        Tuple[DescribedDataFrame, pd.DataFrame]:
+    order_details['quantity'] = cleaning.parse_quantities(order_details['quantity'])
+    order_details['pizza_id'], rejects = normalizer.normalize(order_details['pizza_id'])
+    return order_details, rejects
+
+
+def clean_orders(orders: DescribedDataFrame) -> Tuple[DescribedDataFrame, pd.Series]:
+    dates, dates_report = cleaning.parse_datetimes(orders['date'], cleaning.DATE_FORMATS)
+    times, times_report = cleaning.parse_datetimes(orders['time'], cleaning.TIME_FORMATS)
+    # Parsed once: the day as a datetime and the time of the day as a timedelta, which are filled separately and
+    # then just added up, instead of strings that would have to be concatenated and parsed again
+    orders['date'] = dates.dt.normalize()
+    orders['time'] = times - times.dt.normalize()
+    return orders, pd.concat([dates_report, times_report], keys=['date', 'time'])
 
-    # Formatting orders' dates and times
-    orders.set_index('order_id', inplace=True)
-    orders = pd.to_datetime(orders['date'] + orders['time'], format='%d/%m/%Y%H:%M:%S')
 
-    # Pizzas
-    pizzas = pizzas[['pizza_id', 'price']].set_index('pizza_id')
-    pizzas_dict = pizzas['price'].to_dict()
+def sum_rejects(rejects: List[pd.DataFrame]) -> pd.DataFrame:
+    # Rows of every rejected raw pizza id over several parts of the orders, the most frequent first
+    rejects = pd.concat(rejects).groupby('raw_pizza_id', as_index=False)['rows'].sum()
+    return rejects.sort_values(['rows', 'raw_pizza_id'], ascending=[False, True], ignore_index=True)
 
-    # Not a very neat line of code, but when grouping by order_id, quantities are not taken into account. One solution
-    # is duplicating each row by how many times the pizzas has been ordered.
-    order_details = order_details.reindex(order_details.index.repeat(order_details['quantity'])).reset_index(drop=True)
-    order_details = pd.DataFrame(order_details.groupby(['order_id'])['pizza_id'].apply(list), columns=["order_details"])
-    order_details.index.name = 'order_id'
 
-    def get_price_order(order: List[str]) -> float:
-        return sum([pizzas_dict[pizza_id] for pizza_id in order])
+def previous_rejects() -> pd.DataFrame:
+    # Rejects of the orders processed by the previous runs, which an incremental run adds its own to
+    if not os.path.exists(REJECTS_PATH):
+        return pd.DataFrame({'raw_pizza_id': pd.Series(dtype=object), 'rows': pd.Series(dtype=np.int64)})
+    return pd.read_csv(REJECTS_PATH, dtype={'raw_pizza_id': str, 'rows': np.int64}, keep_default_na=False)
 
-    order_details['price'] = order_details['order_details'].map(get_price_order)
+
+def report_rejects(rejects: pd.DataFrame) -> None:
+    with outputs.atomic(REJECTS_PATH, newline='') as file:
+        rejects.to_csv(file, sep=',', index=False)
+    if not rejects.empty:
+        print(f"{rejects['rows'].sum()} rows with unknown pizza ids were rejected (filled like missing ones):")
+        display(rejects)
+
+
+def concat_dataframes(description: pd.Series, dataframe_container: List[DescribedDataFrame],
+                      menu: Optional[pd.DataFrame] = None) -> Tuple[DescribedDataFrame, DescribedDataFrame]:
+    orders, order_details, pizzas, pizza_types = dataframe_container
+    menu = catalog.build(pizzas, pizza_types) if menu is None else menu
+
+    # Formatting orders' dates and times
+    orders.set_index('order_id', inplace=True)
+    orders = orders['date'] + orders['time']
+
+    # Order lines: one row per (order_id, pizza_id, quantity), with the pizza metadata stored as categorical codes
+    # taken from the catalog rows of the pizza ids. Quantities are kept as weights instead of repeating each row, so
+    # no per-order lists are ever built. Compact dtypes: int32 ids, int8 quantities (unless some does not fit) and
+    # float32 prices, while revenue, which is added up, stays float64
+    order_lines = order_details[['order_id', 'pizza_id', 'quantity']].reset_index(drop=True)
+    order_lines['pizza_id'] = order_lines['pizza_id'].astype('category')
+    rows = catalog.rows(menu, order_lines['pizza_id'])
+    for column in ['pizza_type_id', 'size']:
+        order_lines[column] = catalog.take(menu, column, rows)
+    price = catalog.take(menu, 'price', rows)
+    order_lines['quantity'] = pd.to_numeric(order_lines['quantity'].astype(np.int64), downcast='integer')
+    order_lines['price'] = price.astype(np.float32)
+    order_lines['Timestamp'] = order_lines['order_id'].map(orders)
+    order_lines['revenue'] = price * order_lines['quantity'].to_numpy()
+    order_lines.name = 'order_lines'
+    order_lines.description = description
+
+    # Quantity-weighted sums per order (in int64, int8 sums would overflow)
+    totals = order_lines[['order_id', 'revenue']].assign(quantity=order_lines['quantity'].astype(np.int64))
+    totals = totals.groupby('order_id')[['quantity', 'revenue']].sum()
 
     # Creating our work-dataframe
-    frame = {'Timestamp': orders, 'Order_details': (pizzas := order_details['order_details']),
-             'Amount_ordered': pizzas.str.len(),
-             'Price': order_details['price']}
+    frame = {'Timestamp': orders, 'Amount_ordered': pd.to_numeric(totals['quantity'], downcast='integer'),
+             'Price': totals['revenue']}
     result = DescribedDataFrame(frame)
+    result.index.name = 'order_id'
     result.name = 'summed_dataframe'
     result.description = description
-    return result
-
-
-def weekly_pizzas(dataframe: DescribedDataFrame, types_only: bool = False) -> pd.DataFrame:
-    dataframe = dataframe.copy()
-    if types_only:
-        dataframe['Order_details'] = dataframe['Order_details'].apply(lambda order_details: [pizza.rsplit('_', 1)[0]
-                                                                                             for pizza in order_details]
-                                                                      )
-    weeks = pd.DataFrame(dataframe.groupby([dataframe['Timestamp'
-                                                      ].dt.strftime('%W')])['Order_details'].apply(sum))
-    weeks = weeks.rename(columns={"summed_dataframe": "Pizzas"})
-    weeks.index.name = "week"
-    weeks = weeks.explode('Pizzas').pivot_table(index="week", columns='Pizzas',
-                                                aggfunc="size", fill_value=0)
-    return weeks
-
-
-def count_ingredients(dataframe: DescribedDataFrame, pizzas_dataframe: DescribedDataFrame) -> Tuple[pd.Series,
-                                                                                                    pd.DataFrame]:
-    pizzas_dataframe = pizzas_dataframe[['pizza_type_id', 'ingredients']].set_index('pizza_type_id')
-
-    def check_missing_ingredients(ingredients: str):
-        if 'Sauce' not in ingredients:
-            ingredients += ', Tomato Sauce'
-        if 'Mozzarella Cheese' not in ingredients:
-            ingredients += ', Mozzarella Cheese'
-        return ingredients
-
-    pizzas_dataframe['ingredients'] = pizzas_dataframe['ingredients'].apply(check_missing_ingredients)
-    pizzas_dataframe['ingredients'] = pizzas_dataframe['ingredients'].apply(lambda string: string.split(', '))
-    pizzas_dict = pizzas_dataframe['ingredients'].to_dict()
-
-    def get_ingredients(order_details: List[str]) -> List[str]:
-        total_ingredients_list = []
-        for ingredients_list in [pizzas_dict[pizza.rsplit('_', 1)[0]] for pizza in order_details]:
-            total_ingredients_list += ingredients_list
-        return total_ingredients_list
-
-    dataframe['Ingredients'] = dataframe['Order_details'].apply(get_ingredients)
+    return result, order_lines
+
+
+def weekly_pizzas(order_lines: DescribedDataFrame, types_only: bool = False) -> pd.DataFrame:
+    pizzas = order_lines['pizza_type_id' if types_only else 'pizza_id'].astype('category')
+    return aggregation.weekly_table(aggregation.week_codes(order_lines['Timestamp']), pizzas.cat.codes.to_numpy(),
+                                    pd.Index(pizzas.cat.categories.astype(str), name='Pizzas'),
+                                    weights=order_lines['quantity'].to_numpy())
+
+
+def pizzas_to_ingredients(table: pd.DataFrame, menu: pd.DataFrame, pizzas_dataframe: DescribedDataFrame,
+                          size_multipliers: Optional[Dict[str, float]] = None) -> pd.DataFrame:
+    # Any table with pizza ids as columns times the pizza -> ingredient recipe matrix, so no ingredient strings
+    # are built
+    pizzas = catalog.lookup(menu, table.columns, ['pizza_type_id', 'size'])
+
+    matrix, types, ingredients = recipes.recipe_matrix(pizzas_dataframe)
+    matrix = recipes.pizza_recipe_matrix(matrix, types, pizzas, size_multipliers)
+    return recipes.consumption(table, matrix, ingredients)
+
+
+def count_ingredients(order_lines: DescribedDataFrame, menu: pd.DataFrame, pizzas_dataframe: DescribedDataFrame,
+                      size_multipliers: Optional[Dict[str, float]] = None) -> Tuple[pd.Series, pd.DataFrame]:
+    # Weekly pizzas (with sizes) times the recipes
+    weeks_ingredients = pizzas_to_ingredients(weekly_pizzas(order_lines, types_only=False), menu, pizzas_dataframe,
+                                              size_multipliers)
 
     # Get total count of each ingredient
-    temp = pd.Series([item for sublist in dataframe['Ingredients'] for item in sublist])
-    total_count = temp.groupby(temp).size()
+    total_count = weeks_ingredients.sum(axis=0)
     total_count.name = "Total_Count"
     total_count.index.name = "Ingredients"
+    return total_count, weeks_ingredients
 
-    # Separate by weeks
-    weeks_ingredients = pd.DataFrame(dataframe.groupby([dataframe['Timestamp'
-                                                                  ].dt.strftime('%W')])['Ingredients'].apply(sum))
-    weeks_ingredients = weeks_ingredients.rename(columns={"summed_dataframe": "Ingredients"})
-    weeks_ingredients.index.name = "week"
 
-    weeks_ingredients = weeks_ingredients.explode('Ingredients').pivot_table(index="week", columns='Ingredients',
-                                                                             aggfunc="size", fill_value=0)
+def stream_dataframes(description: pd.Series, dataframe_container: Dict[str, DescribedDataFrame],
+                      bucket_size: int, csv: bool = True) -> Tuple[pd.Series, pd.DataFrame]:
+    # Out of core version of clean_dataframes + concat_dataframes + weekly_pizzas + count_ingredients, for order
+    # histories that do not fit in memory. Peak memory depends on the chunk and bucket sizes only.
+    pizzas, pizza_types = dataframe_container["pizzas.csv"], dataframe_container["pizza_types.csv"]
+    normalizer = cleaning.PizzaIdNormalizer(pizzas['pizza_id'])
+    menu = catalog.build(pizzas, pizza_types)
+    store.save('catalog', menu)
+    keys = ORDERS_KEYS
+    first_valid = {csv_name: {} for csv_name in keys}
+    formats_report, rejects, columns = None, [], {}
+    buckets = defaultdict(list)
+    # The raw files are profiled as they are read, so the analysis xml covers them as a whole
+    profiles = {csv_name: profiling.Profile(csv_name.split('.csv')[0]) for csv_name in dataframe_container}
+    for csv_name, dataframe in dataframe_container.items():
+        if csv_name not in keys:
+            profiles[csv_name].update(dataframe)
+
+    with tempfile.TemporaryDirectory() as spill_directory:
+        # First pass: row-wise cleaning of every chunk, which is then spilled to disk in ranges of order ids
+        for csv_name in keys:
+            for number, chunk in enumerate(dataframe_container[csv_name]):
+                chunk = DescribedDataFrame(chunk)
+                instrumentation.rows_read(chunk)
+                profiles[csv_name].update(chunk)
+                if csv_name == "orders.csv":
+                    chunk, chunk_report = clean_orders(chunk)
+                    formats_report = chunk_report if formats_report is None else formats_report + chunk_report
+                else:
+                    chunk, chunk_rejects = clean_order_details(chunk, normalizer)
+                    rejects.append(chunk_rejects)
+                columns[csv_name] = chunk.columns
+
+                # bfill only reaches the rows before the first valid value (in sorted order) of each column
+                for column in chunk.columns.difference(keys[csv_name]):
+                    valid = chunk.loc[chunk[column].notna(), keys[csv_name] + [column]]
+                    if not valid.empty:
+                        candidate = valid.nsmallest(1, keys[csv_name]).iloc[0]
+                        key = tuple(candidate[keys[csv_name]])
+                        if column not in first_valid[csv_name] or key < first_valid[csv_name][column][0]:
+                            first_valid[csv_name][column] = (key, candidate[column])
+
+                for bucket, part in chunk.groupby(chunk['order_id'] // bucket_size):
+                    part.to_pickle(file_name := os.path.join(spill_directory, f'{csv_name}.{bucket}.{number}.pkl'))
+                    buckets[bucket, csv_name].append(file_name)
+
+        normalizer.save()
+        report_rejects(sum_rejects(rejects))
+        print("Rows matched by each date/time format:")
+        display(formats_report)
+
+        # Second pass: buckets in order of order ids, filled with the last valid values of the previous bucket
+        carry = {csv_name: pd.Series({column: value for column, (key, value) in first_valid[csv_name].items()},
+                                     dtype=object) for csv_name in keys}
+        weeks, weeks_sizes, weeks_ingredients = None, None, None
+        # The csv exports of the parts replace the old ones once they are all in
+        with store.appending('clean_dataframe', 'order_lines'):
+            for position, bucket in enumerate(sorted({bucket for bucket, csv_name in buckets})):
+                frames = []
+                for csv_name in keys:
+                    parts = [pd.read_pickle(file_name) for file_name in buckets.get((bucket, csv_name), [])]
+                    frame = DescribedDataFrame(pd.concat(parts, ignore_index=True) if parts else
+                                               pd.DataFrame(columns=columns[csv_name]))
+                    frame = frame.sort_values(by=keys[csv_name], ignore_index=True).ffill(axis=0)
+                    frame = frame.fillna(carry[csv_name])
+                    if not frame.empty:
+                        carry[csv_name] = frame.iloc[-1]
+                    frames.append(frame)
+
+                dataframe_pd, order_lines = concat_dataframes(description, frames + [pizzas, pizza_types], menu)
+                store.append('clean_dataframe', dataframe_pd, position, csv=csv)
+                store.append('order_lines', order_lines, position, csv=csv)
+
+                # Partial weekly aggregates of the bucket
+                weeks = aggregation.add_tables(weeks, weekly_pizzas(order_lines, types_only=True))
+                weeks_sizes = aggregation.add_tables(weeks_sizes, weekly_pizzas(order_lines, types_only=False))
+                weeks_ingredients = aggregation.add_tables(weeks_ingredients,
+                                                           count_ingredients(order_lines, menu, pizza_types)[1])
+
+    store.save('pizzas_weeks_types', weeks, csv=csv)
+    store.save('pizzas_weeks_sizes', weeks_sizes, csv=csv)
+    store.save('ingredients_weeks', weeks_ingredients, csv=csv)
+    profiles = profile_stored(list(profiles.values()))
+    profiling.save(profiles)
+    profile_dataframes(profiles)
+    manifest.save(max(carry[csv_name]['order_id'] for csv_name in keys), carry)
+    total_count = weeks_ingredients.sum(axis=0)
+    total_count.name = "Total_Count"
+    total_count.index.name = "Ingredients"
     return total_count, weeks_ingredients
 
 
+def update_dataframes(description: pd.Series, dataframe_container: Dict[str, DescribedDataFrame], previous: dict,
+                      csv: bool = True) -> Optional[Tuple[pd.Series, pd.DataFrame, List[str]]]:
+    # Incremental version of the pipeline: only the rows appended to orders.csv and order_details.csv since the
+    # last run (see manifest.py) are cleaned and aggregated, and merged into the stored weekly tables.
+    # Returns None when the new rows are not all after the last processed order, so a full run is needed.
+    pizzas, pizza_types = dataframe_container["pizzas.csv"], dataframe_container["pizza_types.csv"]
+    normalizer = cleaning.PizzaIdNormalizer(pizzas['pizza_id'])
+    menu = catalog.build(pizzas, pizza_types)
+    # The rows of the files are added to the profiles of the previous runs, the menu files are profiled again
+    profiles = {profile.name: profile for profile in profiling.load()}
+    profiles.update({dataframe.name: profiling.Profile(dataframe.name).update(dataframe)
+                     for dataframe in dataframe_container.values()})
+    frames, carry = [], {}
+    for csv_name, keys in ORDERS_KEYS.items():
+        columns = pd.read_csv('data/' + csv_name, nrows=0, **ORDERS_READ_OPTIONS).columns
+        frame = DescribedDataFrame(pd.read_csv(io.BytesIO(manifest.appended_bytes(previous, csv_name)), header=None,
+                                               names=columns, **ORDERS_READ_OPTIONS))
+        instrumentation.rows_read(frame)
+        if (frame['order_id'] <= previous['last_order_id']).any():
+            return None
+        profiles[csv_name.split('.csv')[0]].update(frame)
+        if csv_name == "orders.csv":
+            frame = clean_orders(frame)[0]
+        else:
+            frame, rejects = clean_order_details(frame, normalizer)
+            report_rejects(sum_rejects([previous_rejects(), rejects]))
+
+        # Filled as if these rows were still at the end of the whole file
+        frame = frame.sort_values(by=keys, ignore_index=True).ffill(axis=0)
+        frame = frame.fillna(manifest.carried(previous, csv_name, frame.dtypes)).bfill(axis=0)
+        carry[csv_name] = frame.iloc[-1] if not frame.empty else manifest.carried(previous, csv_name, frame.dtypes)
+        frames.append(frame)
+    normalizer.save()
+    last_order_id = max([previous['last_order_id']] + [frame['order_id'].max() for frame in frames if not frame.empty])
+
+    weeks, weeks_sizes = store.load('pizzas_weeks_types'), store.load('pizzas_weeks_sizes')
+    weeks_ingredients, changed_weeks = store.load('ingredients_weeks'), []
+    if not (frames[0].empty and frames[1].empty):
+        dataframe_pd, order_lines = concat_dataframes(description, frames + [pizzas, pizza_types], menu)
+        with store.appending('clean_dataframe', 'order_lines'):
+            store.append('clean_dataframe', dataframe_pd, csv=csv)
+            store.append('order_lines', order_lines, csv=csv)
+        profiles = {profile.name: profile for profile in profile_stored(list(profiles.values()), new_parts=True)}
+
+        # Only the weeks of the new orders change
+        codes = aggregation.week_codes(dataframe_pd['Timestamp'])
+        changed_weeks = list(aggregation.week_labels()[np.unique(codes[codes >= 0])])
+        weeks = aggregation.add_tables(weeks, weekly_pizzas(order_lines, types_only=True))
+        weeks_sizes = aggregation.add_tables(weeks_sizes, weekly_pizzas(order_lines, types_only=False))
+        weeks_ingredients = aggregation.add_tables(weeks_ingredients,
+                                                   count_ingredients(order_lines, menu, pizza_types)[1])
+        store.save('pizzas_weeks_types', weeks, csv=csv)
+        store.save('pizzas_weeks_sizes', weeks_sizes, csv=csv)
+        store.save('ingredients_weeks', weeks_ingredients, csv=csv)
+        # The cubes of the new orders are added up with the stored ones (the menu, and so the catalog, did not change)
+        if store.files('cube_orders') and store.files('cube_pizzas'):
+            store.save('cube_orders', cube.merge([store.load('cube_orders'), cube.build_orders(dataframe_pd)]))
+            store.save('cube_pizzas', cube.merge([store.load('cube_pizzas'), cube.build_pizzas(order_lines, menu)]))
+        else:
+            build_cubes(menu)
+
+    profiles = list(profiles.values())
+    profiling.save(profiles)
+    profile_dataframes(profiles)
+    manifest.save(last_order_id, carry)
+    total_count = weeks_ingredients.sum(axis=0)
+    total_count.name = "Total_Count"
+    total_count.index.name = "Ingredients"
+    return total_count, weeks_ingredients, changed_weeks
+
+
+def find_partitions(root: str) -> List[Tuple[str, str, str]]:
+    # (store, period, directory) of every root/<store>/<period>/ directory with an orders.csv and order_details.csv,
+    # where period is a year or a month (e.g. 2015 or 2015-07)
+    found = []
+    for store_name in sorted(os.listdir(root)):
+        if not os.path.isdir(os.path.join(root, store_name)):
+            continue
+        for period in sorted(os.listdir(os.path.join(root, store_name))):
+            directory = os.path.join(root, store_name, period)
+            if all(os.path.exists(os.path.join(directory, csv_name)) for csv_name in ORDERS_KEYS):
+                found.append((store_name, period, directory))
+    return found
+
+
+PARTITION_TABLES = ['pizzas_weeks_types', 'pizzas_weeks_sizes', 'ingredients_weeks']
+
+
+def process_partition(directory: str, description: pd.Series, pizzas: DescribedDataFrame,
+                      pizza_types: DescribedDataFrame) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+    # Cleans the orders of one store and period and aggregates them by ISO year-week. Runs in a worker process: the
+    # pizza id cache is read, but only the main process would write it
+    frames = []
+    for csv_name in ORDERS_KEYS:
+        frame = DescribedDataFrame(pd.read_csv(os.path.join(directory, csv_name), **ORDERS_READ_OPTIONS))
+        frame.name = csv_name.split('.csv')[0]
+        frames.append(frame)
+    normalizer = cleaning.PizzaIdNormalizer(pizzas['pizza_id'])
+    dataframe_container, rejects, formats_report = clean_frames(frames + [pizzas, pizza_types], normalizer)
+    menu = catalog.build(dataframe_container[2], dataframe_container[3])
+    dataframe_pd, order_lines = concat_dataframes(description, dataframe_container, menu)
+
+    week_code, weeks = aggregation.iso_week_codes(order_lines['Timestamp'])
+    tables = {}
+    for name, column in [('pizzas_weeks_types', 'pizza_type_id'), ('pizzas_weeks_sizes', 'pizza_id')]:
+        pizza_codes = order_lines[column].astype('category')
+        tables[name] = aggregation.keyed_table(week_code, weeks, pizza_codes.cat.codes.to_numpy(),
+                                               pd.Index(pizza_codes.cat.categories.astype(str), name='Pizzas'),
+                                               weights=order_lines['quantity'].to_numpy())
+    tables['ingredients_weeks'] = pizzas_to_ingredients(tables['pizzas_weeks_sizes'], menu, pizza_types)
+    return tables, rejects
+
+
+def partitioned_dataframes(root: str, csv: bool = True, workers: Optional[int] = None) -> pd.DataFrame:
+    # Every store and period is cleaned and aggregated on its own, in parallel, and the weekly tables are then
+    # reduced into per store tables (indexed by store and week) and chain-level tables (by week)
+    partitions = find_partitions(root)
+    if not partitions:
+        raise FileNotFoundError(f"No <store>/<period>/ directories with {' and '.join(ORDERS_KEYS)} in {root}")
+    description, dataframe_container = extract(orders=False)
+    pizzas, pizza_types = dataframe_container["pizzas.csv"], dataframe_container["pizza_types.csv"]
+
+    stores, rejects = defaultdict(dict), []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_partition, directory, description, pizzas, pizza_types)
+                   for _, _, directory in partitions]
+        for (store_name, period, _), future in zip(partitions, futures):
+            tables, partition_rejects = future.result()
+            for name, table in tables.items():
+                stores[name][store_name] = aggregation.add_tables(stores[name].get(store_name), table)
+            rejects.append(partition_rejects)
+            print(f"Processed {store_name}/{period}")
+
+    report_rejects(sum_rejects(rejects))
+    for name in PARTITION_TABLES:
+        per_store = pd.concat(stores[name], names=['store']).fillna(0).astype(np.int64).sort_index(axis=1)
+        store.save(f'stores_{name}', per_store, csv=csv)
+        store.save(f'chain_{name}', per_store.groupby(level='week').sum(), csv=csv)
+    return store.load('chain_ingredients_weeks')
+
+
+def display(*objects) -> None:
+    # IPython is only loaded when something is displayed
+    from IPython.display import display as ipython_display
+    ipython_display(*objects)
+
+
 def visualize_ingredients_consumed(series: pd.Series, dataframe_pizzas: pd.DataFrame,
                                    dataframe_ingredients: pd.DataFrame) -> None:
+    import plotly.express as px
+
     # Amount of total ingredients consumed by each type
     series.sort_values(ascending=False, inplace=True)
     fig = px.bar(series, labels={'Ingredients': 'Ingredient', 'value': 'Amount consumed'},
@@ -204,8 +501,10 @@ def visualize_ingredients_consumed(series: pd.Series, dataframe_pizzas: pd.DataF
     return
 
 
-def predict_next_week(dataframe: pd.DataFrame) -> None:
-    display(predictions := dataframe[dataframe.columns].median().to_frame(name="Amount"))
+def predict_next_week(dataframe: pd.DataFrame, timestamps: Optional[pd.Series] = None) -> pd.DataFrame:
+    # Every column is forecast with the method that did best when backtested over its history
+    forecasts = forecasting.forecast(dataframe, timestamps)
+    display(predictions := forecasts[['Amount']])
     # XML of ingredient amounts predictions
     root = Element('root')
     comment = Comment("Vague prediction of next week ingredients amount.")
@@ -220,75 +519,261 @@ def predict_next_week(dataframe: pd.DataFrame) -> None:
         SubElement(column, 'amount', name='amount').text = str(predictions.loc[ingredient, 'Amount'])
 
     xml_string = parseString(tostring(root)).toprettyxml(indent="   ")
-    with open("predictions.xml", "w") as file:
+    with outputs.atomic("predictions.xml") as file:
         file.write(xml_string)
-    return predictions.to_csv('predictions.csv', sep=',')
-
-
-def main():
+    with outputs.atomic('predictions.csv', newline='') as file:
+        predictions.to_csv(file, sep=',')
+    return forecasts
+
+
+# Raw order files, and the frames with compact dtypes that are kept of them
+RAW_ORDERS = ['orders', 'order_details']
+COMPACT_FRAMES = ['clean_dataframe', 'order_lines']
+
+
+def profile_stored(profiles: List[profiling.Profile], new_parts: bool = False) -> List[profiling.Profile]:
+    # The compact frames profiled as stored, all their parts or only the one just appended (in memory, their indexes
+    # would also count the hash tables of the lookups done on them)
+    compact = {profile.name: profile for profile in profiles if profile.name in COMPACT_FRAMES}
+    for name in COMPACT_FRAMES:
+        profile = compact.setdefault(name, profiling.Profile(name))
+        for file_name in store.files(name)[-1:] if new_parts else store.files(name):
+            part = pd.read_pickle(file_name)
+            instrumentation.rows_read(part)
+            profile.update(part)
+    return [profile for profile in profiles if profile.name not in compact] + list(compact.values())
+
+
+def profile_dataframes(profiles: List[profiling.Profile]) -> None:
+    # Brief description of each dataframe, and of the compact frames kept of the raw orders
+    raw = [profile for profile in profiles if profile.name in RAW_ORDERS]
+    compact = [profile for profile in profiles if profile.name in COMPACT_FRAMES]
+    report = profiling.memory_report(raw, compact) if raw and compact else None
+    outputs.write(profiling.write_xml, profiles, "analysis_dataframes.xml", report)
+    outputs.write(profiling.write_json, profiles, "analysis_dataframes.json")
+
+
+# Stages of the pipeline. They only communicate through files (the store, mostly), so each one can run on its own,
+# in any process, once the ones it depends on are done. The ones writing several exports write them concurrently.
+@outputs.concurrent
+def stage_profile(arguments: argparse.Namespace) -> None:
+    # Profiles of the raw files and of the compact frames, taken by clean while it had them in memory, so the files
+    # are not read twice
+    profile_dataframes(profiling.load())
+
+
+@outputs.concurrent
+def stage_clean(arguments: argparse.Namespace) -> None:
+    # Clean dataframes, profiled as they were read for the profile stage
     description, dataframe_container = extract()
-
-    # Brief description of each dataframe
-    root = Element('root')
-    comment = Comment("Brief analysis of nan's, nulls, data types and data counts of each dataframe")
-    root.append(comment)
-    for dataframe_pd in dataframe_container.values():
-        # dataframe_pd.info()
-        dataframe = SubElement(root, 'file', name='name')
-        dataframe.text = dataframe_pd.name
-        SubElement(dataframe, 'length', name='count').text = str(len(dataframe_pd.index))
-        for column in dataframe_pd.columns:
-            dataframe_column = dataframe_pd[column]
-            column = SubElement(dataframe, 'column', {'column_name': column})
-            SubElement(column, 'nan', name='nan_count').text = str((dataframe_column.isna()).sum())
-            SubElement(column, 'null', name='null_count').text = str((dataframe_column.isnull()).sum())
-            SubElement(column, 'data_type', name='data_type').text = str(dataframe_column.dtype)
-            SubElement(column, 'unique', name='count').text = str(dataframe_column.nunique())
-
-    xml_string = parseString(tostring(root)).toprettyxml(indent="   ")
-    with open("analysis_dataframes.xml", "w") as file:
-        file.write(xml_string)
-
-    # Clean dataframes
+    profiles = [profiling.Profile(dataframe.name).update(dataframe) for dataframe in dataframe_container.values()]
     dataframe_container = clean_dataframes(dataframe_container)
     print("Cleaned dataframes:")
     display(dataframe_container[0])
     display(dataframe_container[1])
-
-    # Creating main dataframe to work with.
-    dataframe_pd = concat_dataframes(description, dataframe_container)
-    dataframe_pd.to_csv("processed_data/clean_dataframe.csv", sep=',')
+    last_order_id = max(dataframe_container[0]['order_id'].max(), dataframe_container[1]['order_id'].max())
+    carry = {"orders.csv": dataframe_container[0].iloc[-1], "order_details.csv": dataframe_container[1].iloc[-1]}
+
+    # Creating main dataframe to work with, and the menu every later stage looks pizza ids up in
+    menu = catalog.build(dataframe_container[2], dataframe_container[3])
+    dataframe_pd, order_lines = concat_dataframes(description, dataframe_container, menu)
+    store.save('catalog', menu)
+    store.save('clean_dataframe', dataframe_pd, csv=arguments.csv)
+    store.save('order_lines', order_lines, csv=arguments.csv)
+    profiling.save(profile_stored(profiles))
+    manifest.save(last_order_id, carry)
     print("\nSummed dataframe")
     display(dataframe_pd)
     # display(dataframe.describe())
 
+
+@outputs.concurrent
+def stage_weekly(arguments: argparse.Namespace) -> None:
     # Now let's create some useful dataframes to solve our problem.
     # Amount and type of pizzas ordered each week
-    weeks = weekly_pizzas(dataframe_pd, types_only=True)
-    weeks.to_csv("processed_data/pizzas_weeks(with types_only).csv", sep=',')
-    # Creating csv weekly pizzas with sizes as well for utility in the report
-    weekly_pizzas(dataframe_pd, types_only=False).to_csv("processed_data/pizzas_weeks(with sizes).csv", sep=',')
+    order_lines = store.load('order_lines')
+    weeks = weekly_pizzas(order_lines, types_only=True)
+    store.save('pizzas_weeks_types', weeks, csv=arguments.csv)
+    # Creating weekly pizzas with sizes as well for utility in the report
+    store.save('pizzas_weeks_sizes', weekly_pizzas(order_lines, types_only=False), csv=arguments.csv)
     print("\nPizzas per week:")
     display(weeks)
 
+
+@outputs.concurrent
+def stage_ingredients(arguments: argparse.Namespace) -> None:
     # Amount of total ingredients consumed by each type
-    pizza_types = dataframe_container[-1]
-    total_count, weeks_ingredients = count_ingredients(dataframe_pd, pizza_types)
+    description, dataframe_container = extract(orders=False)
+    total_count, weeks_ingredients = count_ingredients(store.load('order_lines'), store.load('catalog'),
+                                                       dataframe_container["pizza_types.csv"])
     print("\nTotal amount of ingredients:")
     display(total_count)
 
     # Amount and type of ingredients consumed each week
-    weeks_ingredients.to_csv("processed_data/ingredients_weeks.csv", sep=',')
+    store.save('ingredients_weeks', weeks_ingredients, csv=arguments.csv)
     print("\nIngredients per week:")
     display(weeks_ingredients)
 
     # You can visualize some graphs via this function, however the report will be done on pdf, so animations
     # and other interactive resources cannot be implemented.
-    # visualize_ingredients_consumed(total_count, weeks, weeks_ingredients)
+    # visualize_ingredients_consumed(total_count, store.load('pizzas_weeks_types'), weeks_ingredients)
+
+
+@outputs.concurrent
+def stage_predictions(arguments: argparse.Namespace) -> None:
     print("\nConclusion:")
-    predict_next_week(weeks_ingredients)
+    # Only the first and last order matter to the forecasts, taken from the cube so the order lines (which may be
+    # bigger than memory) are not loaded
+    timestamps = cube.span(store.load('cube_orders'))
+    forecasts = predict_next_week(store.load('ingredients_weeks'), timestamps)
+    store.save('forecasts', forecasts, csv=arguments.csv)
+    store.save('pizza_forecasts', forecasting.forecast(store.load('pizzas_weeks_types'), timestamps),
+               csv=arguments.csv)
+
+    # Next week forecast split by day of the week, as the days have been so far
+    description, dataframe_container = extract(orders=False)
+    weekdays = cube.ingredients(store.load('cube_pizzas'), dataframe_container["pizza_types.csv"], 'weekday')
+    weekdays.index = pd.Index(aggregation.WEEKDAYS, name='weekday')[weekdays.index]
+    store.save('weekday_forecasts', forecasting.weekday_shares(weekdays).reindex(columns=forecasts.index).fillna(1 / 7)
+               .mul(forecasts['Amount'], axis=1).round(1), csv=arguments.csv)
+
+
+def build_cubes(menu: pd.DataFrame) -> None:
+    # Built part by part when the frames are stored in parts
+    store.save('cube_orders', cube.merge(cube.build_orders(part) for part in store.parts('clean_dataframe')))
+    store.save('cube_pizzas', cube.merge(cube.build_pizzas(part, menu) for part in store.parts('order_lines')))
+
+
+def stage_cube(arguments: argparse.Namespace) -> None:
+    # Orders, pizzas and revenue by hour and day (and pizza), which every rollup by time is queried from
+    build_cubes(store.load('catalog'))
+
+
+def stage_report(arguments: argparse.Namespace) -> None:
+    # The pdf report (and the plotting libraries behind it) is only loaded when it is produced, so headless runs
+    # start without it
+    import report
     report.create_report()
-    excel.create_excel()
+
+
+def stage_excel(arguments: argparse.Namespace) -> None:
+    import excel
+    excel.create_excel(details=arguments.excel_details)
+
+
+DATA_CSVS = 'data/*.csv'
+STAGES = [
+    dag.Stage('profile', stage_profile, ['clean'], [DATA_CSVS],
+              ["analysis_dataframes.xml", "analysis_dataframes.json"]),
+    dag.Stage('clean', stage_clean, [], [DATA_CSVS],
+              [store.pattern('clean_dataframe'), store.pattern('order_lines'), store.pattern('catalog'),
+               manifest.MANIFEST_PATH, profiling.PROFILES_PATH]),
+    dag.Stage('weekly', stage_weekly, ['clean'], [],
+              [store.pattern('pizzas_weeks_types'), store.pattern('pizzas_weeks_sizes')]),
+    dag.Stage('ingredients', stage_ingredients, ['clean'], ['data/pizzas.csv', 'data/pizza_types.csv'],
+              [store.pattern('ingredients_weeks')]),
+    dag.Stage('cube', stage_cube, ['clean'], [],
+              [store.pattern('cube_orders'), store.pattern('cube_pizzas')]),
+    dag.Stage('predictions', stage_predictions, ['clean', 'weekly', 'ingredients', 'cube'], ['data/pizza_types.csv'],
+              ["predictions.xml", "predictions.csv", store.pattern('forecasts'), store.pattern('pizza_forecasts'),
+               store.pattern('weekday_forecasts')]),
+    dag.Stage('report', stage_report, ['clean', 'weekly', 'ingredients', 'cube', 'predictions'], [],
+              ["report_maven.pdf"]),
+    dag.Stage('excel', stage_excel, ['clean', 'weekly', 'ingredients', 'cube'], [], ["report_maven_excel.xlsx"]),
+]
+DOCUMENTS = ['report', 'excel']
+# Stages whose outputs the streaming and incremental modes write by themselves (the incremental one adds the new
+# orders to the cubes too)
+DATA_STAGES = ['clean', 'weekly', 'ingredients']
+UPDATED_STAGES = DATA_STAGES + ['cube']
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Maven Pizza data analytics pipeline")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="stream orders.csv and order_details.csv in chunks of this many rows")
+    parser.add_argument('--no-csv', dest='csv', action='store_false',
+                        help="only write the processed data to the binary store, without the csv exports")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process the orders appended to the data files since the last run")
+    parser.add_argument('--partitions', default=None, metavar='DIRECTORY',
+                        help="process the orders of several stores and periods, in DIRECTORY/<store>/<period>/")
+    parser.add_argument('--no-documents', dest='documents', action='store_false',
+                        help="only write the processed data and predictions, without the pdf report and excel")
+    parser.add_argument('--no-excel-details', dest='excel_details', action='store_false',
+                        help="leave the per order sheets out of the excel, which only keeps the summaries")
+    parser.add_argument('--target', dest='targets', action='append', choices=[stage.name for stage in STAGES],
+                        help="only run this stage (can be repeated) and the ones it depends on that are out of date")
+    parser.add_argument('--force', action='store_true', help="run the targets even if they are up to date")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="stages run at the same time (by default, as many as processors)")
+    parser.add_argument('--instrument', action='store_true',
+                        help=f"log the time, memory and rows of every stage to {instrumentation.RUN_LOG}")
+    parser.add_argument('--profile-stages', dest='profilers', action='append', choices=instrumentation.PROFILERS,
+                        default=[],
+                        help="also profile every stage with cProfile or tracemalloc (implies --instrument)")
+    arguments = parser.parse_args(argv)
+    run_id = instrumentation.new_run_id() if arguments.instrument or arguments.profilers else None
+    try:
+        run_pipeline(arguments, instrumentation.instrument(STAGES, run_id, arguments.profilers), run_id)
+    finally:
+        if run_id is not None:
+            print(f"\nStages of run {run_id} (logged to {instrumentation.RUN_LOG}):")
+            print(instrumentation.summary(instrumentation.read(run_id)).to_string())
+
+
+def run_pipeline(arguments: argparse.Namespace, stages: List[dag.Stage], run_id: Optional[str] = None) -> None:
+    # Stages that only use what the data stages wrote
+    leaves = ['predictions'] + (DOCUMENTS if arguments.documents else [])
+
+    if arguments.targets:
+        ran = dag.run(stages, arguments.targets, arguments, force=arguments.force, workers=arguments.jobs)
+        print(f"Stages run: {', '.join(ran)}" if ran else "Everything is up to date.")
+        return
+
+    if arguments.partitions is not None:
+        # Chain of stores: weekly tables per store and for the whole chain, keyed by ISO year-week
+        with instrumentation.logged('partitions', run_id, arguments.profilers), outputs.Writer():
+            chain_ingredients = partitioned_dataframes(arguments.partitions, arguments.csv, arguments.jobs)
+            print("\nTotal amount of ingredients in the chain:")
+            display(chain_ingredients.sum(axis=0))
+            store.save('chain_forecasts', forecasting.forecast(chain_ingredients), csv=arguments.csv)
+        return
+
+    if arguments.incremental:
+        previous = manifest.load()
+        reason = manifest.check(previous)
+        if reason is None:
+            with instrumentation.logged('update', run_id, arguments.profilers), outputs.Writer():
+                description, dataframe_container = extract(orders=False)
+                result = update_dataframes(description, dataframe_container, previous, arguments.csv)
+            if result is None:
+                reason = "some new rows belong to orders that were already processed"
+            elif not result[-1]:
+                print("No new orders since the last run, nothing to update.")
+                return
+            else:
+                # Only the tables the new orders changed were written, so like make, only the stages reading them run
+                total_count, weeks_ingredients, changed_weeks = result
+                print(f"Updated weeks: {', '.join(changed_weeks)}")
+                ran = dag.run(stages, leaves, arguments, done=UPDATED_STAGES, workers=arguments.jobs)
+                print(f"Stages run: {', '.join(ran)}" if ran else "Everything else is up to date.")
+                return
+        print(f"Running the whole pipeline: {reason}.")
+
+    if arguments.chunksize is not None:
+        # Streaming mode: nothing bigger than a chunk (or a bucket of as many order ids) is held in memory
+        with instrumentation.logged('stream', run_id, arguments.profilers), outputs.Writer():
+            description, dataframe_container = extract(arguments.chunksize)
+            total_count, weeks_ingredients = stream_dataframes(description, dataframe_container, arguments.chunksize,
+                                                               arguments.csv)
+        print("\nTotal amount of ingredients:")
+        display(total_count)
+        dag.run(stages, leaves, arguments, force=True, done=DATA_STAGES, workers=arguments.jobs)
+        return
+
+    # Everything is run again
+    dag.run(stages, ['profile'] + DATA_STAGES + leaves, arguments, force=True, workers=arguments.jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+import pandas as pd
+
+import outputs
+
+# What the last run processed: checksums of the raw files, the highest order id and the last valid value of every
+# filled column, so the next run can carry on from there with only the rows appended since.
+MANIFEST_PATH = 'processed_data/store/manifest.json'
+# Bumped when what is carried changes (2: dates and times as datetimes and timedeltas, not formatted strings, 3: the
+# profiles of the data are kept, and every date and time format is parsed)
+MANIFEST_VERSION = 3
+APPEND_ONLY_CSVS = ["orders.csv", "order_details.csv"]
+CATALOG_CSVS = ["pizzas.csv", "pizza_types.csv", "data_dictionary.csv"]
+DATA_DIRECTORY = 'data/'
+
+
+def checksum(file_path: str, size: Optional[int] = None) -> str:
+    # sha1 of the first size bytes of the file (all of it by default)
+    digest = hashlib.sha1()
+    remaining = os.path.getsize(file_path) if size is None else size
+    with open(file_path, 'rb') as file:
+        while remaining > 0:
+            block = file.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def load() -> Optional[dict]:
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    with open(MANIFEST_PATH, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def to_json(value):
+    if pd.isna(value):
+        return None
+    if isinstance(value, (pd.Timestamp, pd.Timedelta)):
+        return str(value)
+    return value.item() if hasattr(value, 'item') else value
+
+
+def carried(manifest: dict, csv_name: str, dtypes: pd.Series) -> pd.Series:
+    # The last valid values of the previous run, as values of the dtypes of the columns they fill
+    values = {}
+    for column, value in manifest['carry'][csv_name].items():
+        if value is not None and pd.api.types.is_datetime64_dtype(dtypes.get(column)):
+            value = pd.Timestamp(value)
+        elif value is not None and pd.api.types.is_timedelta64_dtype(dtypes.get(column)):
+            value = pd.Timedelta(value)
+        values[column] = value
+    return pd.Series(values, dtype=object)
+
+
+def save(last_order_id: int, carry: Dict[str, pd.Series]) -> None:
+    files = {}
+    for csv_name in APPEND_ONLY_CSVS + CATALOG_CSVS:
+        file_path = os.path.join(DATA_DIRECTORY, csv_name)
+        files[csv_name] = {'size': os.path.getsize(file_path), 'sha1': checksum(file_path)}
+    with outputs.atomic(MANIFEST_PATH, encoding='utf-8') as file:
+        json.dump({'version': MANIFEST_VERSION, 'files': files, 'last_order_id': int(last_order_id),
+                   'carry': {csv_name: {column: to_json(value) for column, value in values.items()}
+                             for csv_name, values in carry.items()}}, file, indent=3)
+
+
+def check(manifest: Optional[dict]) -> Optional[str]:
+    # Why the last run cannot be extended (None if it can): the menu changed, or some of the rows it
+    # processed are not there anymore (the files were rewritten instead of appended to)
+    if manifest is None:
+        return "there is no manifest of a previous run"
+    if manifest.get('version') != MANIFEST_VERSION:
+        return "the manifest was written by another version of the pipeline"
+    for csv_name in CATALOG_CSVS:
+        if checksum(os.path.join(DATA_DIRECTORY, csv_name)) != manifest['files'][csv_name]['sha1']:
+            return f"{csv_name} changed"
+    for csv_name in APPEND_ONLY_CSVS:
+        file_path, previous = os.path.join(DATA_DIRECTORY, csv_name), manifest['files'][csv_name]
+        if os.path.getsize(file_path) < previous['size'] or \
+                checksum(file_path, previous['size']) != previous['sha1']:
+            return f"{csv_name} was modified, not only appended to"
+        with open(file_path, 'rb') as file:
+            file.seek(previous['size'] - 1)
+            if file.read(1) != b'\n':
+                return f"the last row of {csv_name} was not complete"
+    return None
+
+
+def appended_bytes(manifest: dict, csv_name: str) -> bytes:
+    # Rows written to a raw file after the last run (without its header)
+    with open(os.path.join(DATA_DIRECTORY, csv_name), 'rb') as file:
+        file.seek(manifest['files'][csv_name]['size'])
+        return file.read()
@@ -0,0 +1,107 @@
+import contextlib
+import functools
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, IO, Iterator, List, Optional
+
+# Every artifact (store pickles, csv exports, xml, json, the pdf and the excel) is written to a hidden temporary file
+# next to it and renamed over it once complete, so whoever reads it (the other stages, serve.py, someone opening the
+# workbook) finds the previous version or the new one, never half a file. Within a stage, exports nobody reads back in
+# it (csv, xml, json) are handed over to a pool of threads and written while the stage goes on.
+WRITER_THREADS = 4
+
+# Writer of the stage running in this process, None writes right away
+current: Optional['Writer'] = None
+
+
+def temporary_path(path: str) -> str:
+    # Same directory, so the rename is atomic, and same extension, which some writers go by
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp{os.path.splitext(name)[1]}')
+
+
+@contextlib.contextmanager
+def atomic_path(path: str) -> Iterator[str]:
+    # Path to write the file to instead, moved into place when the block ends (and removed if it fails)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = temporary_path(path)
+    try:
+        yield temporary
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def copy(source: str, destination: str) -> None:
+    # Copied by the kernel, which on copy-on-write filesystems (btrfs, xfs, ...) shares the blocks of the source
+    # instead of writing them again, so copying a big export before appending to it costs next to nothing there
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(source, destination)
+        return
+    with open(source, 'rb') as reader, open(destination, 'wb') as writer:
+        remaining = os.fstat(reader.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(reader.fileno(), writer.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            # Not supported between these files: copied by hand from where it stopped
+            shutil.copyfileobj(reader, writer)
+
+
+@contextlib.contextmanager
+def atomic(path: str, mode: str = 'w', **options) -> Iterator[IO]:
+    # open() for writing, atomically
+    with atomic_path(path) as temporary:
+        with open(temporary, mode, **options) as file:
+            yield file
+
+
+class Writer:
+    # Runs the writes handed over with write() on a pool of threads until the block ends, which waits for all of them
+    # and raises the first one that failed
+    def __init__(self, threads: int = WRITER_THREADS):
+        self.threads = threads
+        self.futures: List[Future] = []
+        self.previous = None
+
+    def __enter__(self) -> 'Writer':
+        global current
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='writer')
+        self.previous, current = current, self
+        return self
+
+    def __exit__(self, exception_type, exception, traceback) -> None:
+        global current
+        current = self.previous
+        self.pool.shutdown(wait=True)
+        if exception_type is None:
+            for future in self.futures:
+                future.result()
+
+    def submit(self, function: Callable, *arguments, **keywords) -> None:
+        self.futures.append(self.pool.submit(function, *arguments, **keywords))
+
+
+def write(function: Callable, *arguments, **keywords) -> None:
+    # The objects written must not change afterwards: they are written whenever a thread of the pool gets to them
+    if current is None:
+        function(*arguments, **keywords)
+    else:
+        current.submit(function, *arguments, **keywords)
+
+
+def concurrent(stage: Callable) -> Callable:
+    # Stage whose writes run on a pool of threads, all of them done when it returns
+    @functools.wraps(stage)
+    def run(*arguments, **keywords):
+        with Writer():
+            return stage(*arguments, **keywords)
+    return run
@@ -0,0 +1,218 @@
+import json
+import pickle
+from typing import Dict, List, Optional, TextIO
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+import pandas as pd
+
+import outputs
+
+# Distinct values are counted exactly up to this many per column, and estimated with a HyperLogLog sketch (2 **
+# HLL_PRECISION registers, ~1.6% standard error) past it, so profiling huge files needs constant memory.
+EXACT_DISTINCT_LIMIT = 100000
+HLL_PRECISION = 12
+# Profiles of the last run, which an incremental run adds the new rows to
+PROFILES_PATH = 'processed_data/store/profiles.pkl'
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, values: pd.Series) -> None:
+        if values.empty:
+            return
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+        # The first bits of the hash pick the register, the position of the first 1 in the rest is its rank
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - np.frexp(rest.astype(np.float64))[1] + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction (linear counting)
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class Profile:
+    # Null counts, dtypes, distinct counts and min/max of every column of a frame, which can be fed whole or in
+    # chunks. Each update is a handful of vectorized passes over the whole chunk, not a loop of passes per column.
+    def __init__(self, name: str, exact_limit: int = EXACT_DISTINCT_LIMIT):
+        self.name = name
+        self.exact_limit = exact_limit
+        self.rows = 0
+        # Bytes the frame takes in memory, strings included
+        self.memory = 0
+        self.nulls: Optional[pd.Series] = None
+        self.dtypes: Dict[str, str] = {}
+        self.minimum: Dict[str, object] = {}
+        self.maximum: Dict[str, object] = {}
+        self.distinct: Dict[str, np.ndarray] = {}
+        self.sketches: Dict[str, HyperLogLog] = {}
+
+    def update(self, frame: pd.DataFrame) -> 'Profile':
+        self.rows += len(frame.index)
+        self.memory += int(frame.memory_usage(deep=True).sum())
+        nulls = frame.isna().sum()
+        self.nulls = nulls if self.nulls is None else self.nulls.add(nulls, fill_value=0).astype(int)
+        for column, dtype in frame.dtypes.items():
+            self.dtypes[column] = combine_dtypes(self.dtypes.get(column), dtype)
+
+        # Numeric and datetime columns get their min/max in a single pass, the rest (text, mostly) column by column
+        numeric = frame.select_dtypes(include=['number', 'datetime'])
+        self.update_range(numeric.min(), numeric.max())
+        for column in frame.columns:
+            values = frame[column].dropna()
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # Only the categories in use matter, for the range as for the distinct values
+                values = pd.Series(values.cat.categories[np.unique(values.cat.codes)])
+            if column not in numeric.columns and not values.empty:
+                self.update_range(pd.Series({column: values.min()}, dtype=object),
+                                  pd.Series({column: values.max()}, dtype=object))
+            if column in self.sketches:
+                self.sketches[column].add(values)
+                continue
+            distinct = pd.unique(values) if column not in self.distinct else \
+                pd.unique(np.concatenate([self.distinct[column], values.to_numpy()]))
+            if len(distinct) > self.exact_limit:
+                # Too many to keep them all: from now on they are only counted approximately
+                self.sketches[column] = HyperLogLog()
+                self.sketches[column].add(pd.Series(distinct))
+                self.distinct.pop(column, None)
+            else:
+                self.distinct[column] = distinct
+        return self
+
+    def update_range(self, minimum: pd.Series, maximum: pd.Series) -> None:
+        for column in minimum.index[minimum.notna()]:
+            self.minimum[column] = minimum[column] if column not in self.minimum else \
+                min(self.minimum[column], minimum[column])
+            self.maximum[column] = maximum[column] if column not in self.maximum else \
+                max(self.maximum[column], maximum[column])
+
+    def columns(self) -> List[dict]:
+        result = []
+        for column, dtype in self.dtypes.items():
+            approximate = column in self.sketches
+            result.append({'column_name': column, 'nan_count': int(self.nulls[column]),
+                           'null_count': int(self.nulls[column]), 'data_type': dtype,
+                           'unique': self.sketches[column].count() if approximate else len(self.distinct[column]),
+                           'approximate': approximate,
+                           'min': to_builtin(self.minimum.get(column)), 'max': to_builtin(self.maximum.get(column))})
+        return result
+
+
+def combine_dtypes(previous: Optional[str], dtype) -> str:
+    # dtype of a column read in chunks: chunks with missing values may have been inferred as float, for instance
+    if previous is None or previous == str(dtype):
+        return str(dtype)
+    try:
+        return str(np.result_type(np.dtype(previous), dtype))
+    except TypeError:
+        return 'object'
+
+
+def to_builtin(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else str(value) if isinstance(value, pd.Timestamp) else value
+
+
+class XmlWriter:
+    # Writes the document as it goes (indented like minidom's toprettyxml), without building or re-parsing a tree
+    def __init__(self, file: TextIO, indent: str = "   "):
+        self.file = file
+        self.indent = indent
+        self.depth = 0
+        file.write('<?xml version="1.0" ?>\n')
+
+    def attributes(self, attributes: Dict[str, str]) -> str:
+        return ''.join(f' {key}={quoteattr(str(value))}' for key, value in attributes.items())
+
+    def start(self, tag: str, attributes: Dict[str, str] = None) -> None:
+        self.file.write(f'{self.indent * self.depth}<{tag}{self.attributes(attributes or {})}>\n')
+        self.depth += 1
+
+    def end(self, tag: str) -> None:
+        self.depth -= 1
+        self.file.write(f'{self.indent * self.depth}</{tag}>\n')
+
+    def text(self, text: str) -> None:
+        self.file.write(f'{self.indent * self.depth}{escape(str(text))}\n')
+
+    def comment(self, text: str) -> None:
+        self.file.write(f'{self.indent * self.depth}<!--{text}-->\n')
+
+    def element(self, tag: str, text, attributes: Dict[str, str] = None) -> None:
+        self.file.write(f'{self.indent * self.depth}<{tag}{self.attributes(attributes or {})}>'
+                        f'{escape(str(text))}</{tag}>\n')
+
+
+def save(profiles: List[Profile], path: str = PROFILES_PATH) -> None:
+    with outputs.atomic(path, 'wb') as file:
+        pickle.dump(profiles, file, protocol=5)
+
+
+def load(path: str = PROFILES_PATH) -> List[Profile]:
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def memory_report(raw: List[Profile], compact: List[Profile]) -> Dict[str, object]:
+    # Memory of the raw frames next to the compact ones the pipeline keeps of them
+    raw_bytes, compact_bytes = sum(profile.memory for profile in raw), sum(profile.memory for profile in compact)
+    return {'raw': ', '.join(profile.name for profile in raw), 'raw_bytes': raw_bytes,
+            'compact': ', '.join(profile.name for profile in compact), 'compact_bytes': compact_bytes,
+            'ratio': round(raw_bytes / compact_bytes, 1) if compact_bytes else None}
+
+
+def write_xml(profiles: List[Profile], path: str, report: Optional[Dict[str, object]] = None) -> None:
+    with outputs.atomic(path) as file:
+        writer = XmlWriter(file)
+        writer.start('root')
+        writer.comment("Brief analysis of nan's, nulls, data types and data counts of each dataframe")
+        for profile in profiles:
+            writer.start('file', {'name': 'name'})
+            writer.text(profile.name)
+            writer.element('length', profile.rows, {'name': 'count'})
+            writer.element('memory', profile.memory, {'name': 'bytes'})
+            for column in profile.columns():
+                writer.start('column', {'column_name': column['column_name']})
+                writer.element('nan', column['nan_count'], {'name': 'nan_count'})
+                writer.element('null', column['null_count'], {'name': 'null_count'})
+                writer.element('data_type', column['data_type'], {'name': 'data_type'})
+                writer.element('unique', column['unique'], {'name': 'count', 'approximate': 'hyperloglog'}
+                               if column['approximate'] else {'name': 'count'})
+                if column['min'] is not None:
+                    writer.element('min', column['min'], {'name': 'min'})
+                    writer.element('max', column['max'], {'name': 'max'})
+                writer.end('column')
+            writer.end('file')
+        if report is not None:
+            writer.start('memory_report')
+            writer.comment("Bytes in memory of the raw files and of the compact frames the pipeline keeps of them")
+            for key, value in report.items():
+                writer.element(key, value, {'name': key})
+            writer.end('memory_report')
+        writer.end('root')
+
+
+def write_json(profiles: List[Profile], path: str) -> None:
+    with outputs.atomic(path) as file:
+        # One file per line, written as soon as it is serialized
+        file.write('[\n')
+        for position, profile in enumerate(profiles):
+            file.write(('' if position == 0 else ',\n') +
+                       json.dumps({'name': profile.name, 'length': profile.rows, 'memory_bytes': profile.memory,
+                                   'columns': profile.columns()}))
+        file.write('\n]\n')
@@ -0,0 +1,48 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Every pizza gets a tomato sauce base unless its recipe already has a sauce, and mozzarella on top
+DEFAULT_SAUCE = 'Tomato Sauce'
+DEFAULT_CHEESE = 'Mozzarella Cheese'
+
+
+def recipe_matrix(pizza_types: pd.DataFrame) -> Tuple[sparse.csr_matrix, pd.Index, pd.Index]:
+    ingredients = pizza_types.set_index('pizza_type_id')['ingredients']
+    ingredients = ingredients.where(ingredients.str.contains('Sauce', regex=False),
+                                    ingredients + ', ' + DEFAULT_SAUCE)
+    ingredients = ingredients.where(ingredients.str.contains(DEFAULT_CHEESE, regex=False),
+                                    ingredients + ', ' + DEFAULT_CHEESE)
+    recipes = ingredients.str.split(', ').explode()
+
+    # pizza_type x ingredient, with a 1 for every ingredient of the recipe (repeated ingredients add up)
+    rows, types = pd.factorize(recipes.index, sort=True)
+    columns, names = pd.factorize(recipes.to_numpy(), sort=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, columns)),
+                               shape=(len(types), len(names)))
+    return matrix, pd.Index(types, name='Pizzas'), pd.Index(names, name='Ingredients')
+
+
+def pizza_recipe_matrix(matrix: sparse.csr_matrix, types: pd.Index, pizzas: pd.DataFrame,
+                        size_multipliers: Optional[Dict[str, float]] = None) -> sparse.csr_matrix:
+    # pizzas: one row per pizza_id with its 'pizza_type_id' and 'size'. The result maps every pizza_id to the
+    # ingredients of its type, scaled by the size multiplier if any (e.g. {'S': 1, 'M': 1.5, 'L': 2}).
+    type_codes = types.get_indexer(pizzas['pizza_type_id'])
+    if size_multipliers is None:
+        weights = np.ones(len(pizzas), dtype=np.int64)
+    else:
+        weights = pizzas['size'].astype(str).str.upper().map(size_multipliers).fillna(1).to_numpy(dtype=float)
+    known = type_codes >= 0
+    selection = sparse.csr_matrix((weights[known], (np.flatnonzero(known), type_codes[known])),
+                                  shape=(len(pizzas), len(types)))
+    return selection @ matrix
+
+
+def consumption(counts: pd.DataFrame, matrix: sparse.csr_matrix, ingredients: pd.Index) -> pd.DataFrame:
+    # counts: any table with pizzas as columns, matching the rows of matrix. One sparse product gives the
+    # ingredients consumed for every row of the table at once.
+    amounts = np.asarray(matrix.T @ counts.to_numpy().T).T
+    result = pd.DataFrame(amounts, index=counts.index, columns=ingredients)
+    return result.loc[:, result.sum(axis=0) > 0]
@@ -0,0 +1,111 @@
+import argparse
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+import store
+
+# The streaming and incremental modes must write exactly what a default run writes for the same data. Every mode is
+# run on a copy of the code and the data in a scratch directory, and its outputs are compared byte for byte with the
+# ones of the default run.
+CHUNKSIZE = 5000
+SPLIT_ORDER_ID = 20000
+# Orders files, and the column of their order ids
+ORDERS_FILES = {'orders.csv': 0, 'order_details.csv': 1}
+OUTPUTS = [store.CSV_EXPORTS[name][0] for name in ['clean_dataframe', 'order_lines', 'pizzas_weeks_types',
+                                                   'pizzas_weeks_sizes', 'ingredients_weeks', 'forecasts',
+                                                   'pizza_forecasts', 'weekday_forecasts']] + \
+          ['processed_data/pizza_id_rejects.csv', 'predictions.csv', 'predictions.xml']
+
+
+def copy_repository(directory: str) -> None:
+    # The code and the data, without any output of a previous run
+    for file_name in os.listdir('.'):
+        if file_name.endswith('.py'):
+            shutil.copy(file_name, directory)
+    shutil.copytree('data', os.path.join(directory, 'data'))
+    shutil.copytree('images', os.path.join(directory, 'images'), ignore=shutil.ignore_patterns('cache'))
+    os.makedirs(os.path.join(directory, 'processed_data'))
+
+
+def run(directory: str, *arguments: str) -> str:
+    result = subprocess.run([sys.executable, 'main.py', '--no-documents', *arguments], cwd=directory,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py {' '.join(arguments)} failed in {directory}:\n{result.stderr[-2000:]}")
+    return result.stdout
+
+
+def split_orders(directory: str, order_id: int) -> Dict[str, bytes]:
+    # Leaves the rows of the orders up to order_id in the orders files, in their order, and returns the other rows of
+    # every file, to be appended to it afterwards
+    later = {}
+    for name, column in ORDERS_FILES.items():
+        file_name = os.path.join(directory, 'data', name)
+        with open(file_name, 'rb') as file:
+            header, *rows = file.read().splitlines(keepends=True)
+        rows = [row if row.endswith(b'\n') else row + b'\r\n' for row in rows if row.strip()]
+        before = [int(row.split(b';')[column]) <= order_id for row in rows]
+        with open(file_name, 'wb') as file:
+            file.write(header + b''.join(row for row, first in zip(rows, before) if first))
+        later[name] = b''.join(row for row, first in zip(rows, before) if not first)
+    return later
+
+
+def run_incremental(directory: str, order_id: int) -> None:
+    later = split_orders(directory, order_id)
+    run(directory)
+    for name, rows in later.items():
+        with open(os.path.join(directory, 'data', name), 'ab') as file:
+            file.write(rows)
+    output = run(directory, '--incremental')
+    if 'Updated weeks' not in output:
+        # A whole run instead would not check the merge at all
+        raise RuntimeError(f"main.py --incremental did not update the stored tables:\n{output[-2000:]}")
+
+
+def compare(reference: str, directory: str) -> List[str]:
+    # Outputs that differ from the reference ones (or are missing)
+    return [name for name in OUTPUTS
+            if not (os.path.exists(os.path.join(directory, name)) and
+                    filecmp.cmp(os.path.join(reference, name), os.path.join(directory, name), shallow=False))]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Check that the streaming and incremental modes write the same "
+                                                 "outputs as a default run, byte for byte")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help="chunk size of the streaming run")
+    parser.add_argument('--split', type=int, default=SPLIT_ORDER_ID, metavar='ORDER_ID',
+                        help="the incremental run first processes the orders up to this one, then the rest")
+    parser.add_argument('--keep', action='store_true', help="keep the directory of every run")
+    arguments = parser.parse_args(argv)
+
+    modes = {'default': lambda directory: run(directory),
+             'chunksize': lambda directory: run(directory, '--chunksize', str(arguments.chunksize)),
+             'incremental': lambda directory: run_incremental(directory, arguments.split)}
+    directories, failed = {}, False
+    try:
+        for mode, run_mode in modes.items():
+            directories[mode] = tempfile.mkdtemp(prefix=f'regression_{mode}_')
+            copy_repository(directories[mode])
+            print(f"Running the {mode} mode in {directories[mode]}...", flush=True)
+            run_mode(directories[mode])
+            if mode == 'default':
+                continue
+            different = compare(directories['default'], directories[mode])
+            failed = failed or bool(different)
+            print(f"{mode}: {len(OUTPUTS) - len(different)} of {len(OUTPUTS)} outputs identical to the default run" +
+                  ''.join(f"\n  different: {name}" for name in different), flush=True)
+    finally:
+        if not arguments.keep:
+            for directory in directories.values():
+                shutil.rmtree(directory, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,44 @@
 import dataframe_image as dfi
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+from PIL import Image
 
 import time
 import os
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
 
 import warnings
-import requests
 import seaborn as sns
 
 from fpdf import FPDF
 
+import catalog
+import chart_cache
+import cube
+import outputs
+import store
+
 TITLE = "Maven Pizza Data Report"
 WIDTH = 210
 HEIGHT = 297
+LOGO_URL = 'https://apps.icai.comillas.edu/iconos/logo-icai.png'
+LOGO_PATH = 'images/logo-icai.png'
 
 warnings.simplefilter("ignore", UserWarning)
-img_data = requests.get('https://apps.icai.comillas.edu/iconos/logo-icai.png').content
-with open('images/logo-icai.png', 'wb') as handler:
-    handler.write(img_data)
+
+
+def logo() -> str:
+    # The logo is kept as a local file, it is only downloaded (once) if it is missing
+    if not os.path.exists(LOGO_PATH):
+        import requests
+        response = requests.get(LOGO_URL, timeout=10)
+        response.raise_for_status()
+        with open(LOGO_PATH, 'wb') as handler:
+            handler.write(response.content)
+    return LOGO_PATH
 
 
 class PDF(FPDF):
@@ -31,6 +50,9 @@ class PDF(FPDF):
 
 
 def create_report():
+    # All the charts have to be rendered before assembling the PDF
+    create_visualizations()
+
     # Create PDF
     pdf = PDF()  # A4 (210 by 297 mm)
 
@@ -41,7 +63,6 @@ def create_report():
     write_to_pdf(pdf, "1. The table below illustrates the Amount of pizzas ordered and their Prices per Week in Maven"
                       " Pizza:")
     pdf.ln(15)
-    create_visualizations()
     pdf.image("images/table_orders.png", h=HEIGHT / 1.8, w=WIDTH / 3.3, x=(WIDTH / 2 - 30))
     pdf.ln(10)
 
@@ -89,11 +110,12 @@ def create_report():
     pdf.ln(10)
 
     # Generate the PDF
-    pdf.output("report_maven.pdf")
+    with outputs.atomic_path("report_maven.pdf") as path:
+        pdf.output(path)
 
 
 def create_letterhead(pdf):
-    pdf.image("images/logo-icai.png", 5, 5, 75, 28.35)
+    pdf.image(logo(), 5, 5, 75, 28.35)
 
 
 def create_title(title, pdf):
@@ -120,25 +142,107 @@ def write_to_pdf(pdf, words):
     pdf.write(5, words)
 
 
-def create_visualizations():
-    clean_dataframe = pd.read_csv("processed_data/clean_dataframe.csv", encoding='latin')
-    ingredients_weeks = pd.read_csv("processed_data/ingredients_weeks.csv", encoding='latin')
-    pizzas_weeks_sizes = pd.read_csv("processed_data/pizzas_weeks(with sizes).csv", encoding='latin')
-    pizzas_weeks = pd.read_csv("processed_data/pizzas_weeks(with types_only).csv", encoding='latin')
-
-    pizza_types = pd.read_csv("data/pizza_types.csv", encoding='latin')
-    ingredients_weeks.set_index('week', inplace=True)
-    pizzas_weeks_sizes.set_index('week', inplace=True)
-    pizzas_weeks.set_index('week', inplace=True)
-
-    # Creating table from clean_dataframe
-    clean_dataframe['Timestamp'] = pd.to_datetime(clean_dataframe['Timestamp'], format='%Y-%m-%d %H:%M:%S')
-    weekly_orders = pd.DataFrame(clean_dataframe.groupby([clean_dataframe['Timestamp'].
-                                                         dt.strftime('%W')])[['Amount_ordered', 'Price']].apply(sum))
+def create_visualizations(workers: Optional[int] = None):
+    # Every chart is an independent task that only needs its own (already computed) data, so they are rendered in
+    # parallel, each one in a separate process with a headless backend. Charts whose data and styling did not change
+    # since they were last drawn are taken from the cache instead
+    tasks = []
+    for render, arguments in chart_tasks():
+        chart_key = chart_cache.key(render, arguments)
+        if not chart_cache.fetch(chart_key, arguments[-1]):
+            tasks.append((chart_key, render, arguments))
+        elif flatten_alpha(arguments[-1]):
+            # Cached before the charts were flattened
+            chart_cache.put(chart_key, arguments[-1])
+    if workers == 1 or len(tasks) <= 1:
+        for _, render, arguments in tasks:
+            render_atomically(render, *arguments)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=matplotlib.use, initargs=('Agg',)) as pool:
+            for future in [pool.submit(render_atomically, render, *arguments) for _, render, arguments in tasks]:
+                future.result()
+    for chart_key, _, arguments in tasks:
+        chart_cache.put(chart_key, arguments[-1])
+    chart_cache.evict()
+
+
+def render_atomically(render: Callable, *arguments) -> None:
+    # The image (the last argument) is drawn to a temporary file renamed over it, so a render that fails half way
+    # leaves the previous image, never a truncated one the pdf or the chart cache would take
+    with outputs.atomic_path(arguments[-1]) as temporary:
+        render(*arguments[:-1], temporary)
+        flatten_alpha(temporary)
+
+
+def flatten_alpha(path: str) -> bool:
+    # The charts are drawn on an opaque background, but saved with an alpha channel fpdf unpacks pixel by pixel in
+    # Python (most of the time the report takes). Dropping it when it is fully opaque leaves the same image.
+    with Image.open(path) as image:
+        if image.mode != 'RGBA' or image.getchannel('A').getextrema() != (255, 255):
+            return False
+        image = image.convert('RGB')
+    with outputs.atomic_path(path) as temporary:
+        image.save(temporary, format='PNG')
+    return True
+
+
+def chart_tasks() -> List[Tuple[Callable, tuple]]:
+    cube_orders = store.load('cube_orders')
+    cube_pizzas = store.load('cube_pizzas')
+    ingredients_weeks = store.load('ingredients_weeks')
+    pizzas_weeks_sizes = store.load('pizzas_weeks_sizes')
+    pizzas_weeks = store.load('pizzas_weeks_types')
+    menu = store.load('catalog')
+
+    # Creating table from the weekly rollup of the orders
+    weekly_orders = cube.query(cube_orders, 'week', measure=['pizzas', 'revenue'])
+    weekly_orders.columns = ['Amount_ordered', 'Price']
     weekly_orders.index.name = "Week"
     weekly_orders.reset_index(inplace=True)
-    weekly_orders['Week'] = weekly_orders['Week'].apply(int)
     weekly_orders['Amount_ordered'] = weekly_orders['Amount_ordered'].apply(int)
+
+    # Pizzas
+    pizzas_sum = pizzas_weeks.sum(axis=0).to_frame(name="Amount")
+    pizzas_sum['Pizza'] = pizzas_sum.index
+    pizzas_sum.reset_index(inplace=True)
+    pizzas_sum.sort_values('Amount', ascending=False, inplace=True)
+
+    # Pizzas with sizes
+    pizzas_sizes_sum = pizzas_weeks_sizes.sum(axis=0).to_frame(name="Amount")
+    pizzas_sizes_sum['Size'] = pizzas_sizes_sum.index
+    pizzas_sizes_sum.reset_index(inplace=True)
+    pizzas_sizes_sum.sort_values('Amount', ascending=False, inplace=True)
+    pizzas = catalog.lookup(menu, pizzas_sizes_sum['Size'], ['pizza_type_id', 'size'])
+    pizzas_sizes_sum['Pizza'] = pizzas['pizza_type_id'].astype(str).to_numpy()
+    pizzas_sizes_sum['Size'] = pizzas['size'].astype(str).str.upper().to_numpy()
+
+    # Ingredients
+    ingredients_sum = ingredients_weeks.sum(axis=0)
+    ingredients_sum.index.name = 'Ingredients'
+    ingredients_sum.sort_values(ascending=False, inplace=True)
+
+    # Pizza categories
+    pizza_categories = cube.query(cube_pizzas, by='category')
+    pizza_categories.index = pizza_categories.index.astype(str).rename("Category")
+    pizza_categories.name = 'Amount'
+
+    # Pizza sizes
+    pizza_sizes = pizzas_sizes_sum.groupby("Size")['Amount'].sum()
+
+    # Predictions
+    prediction_df = store.load('forecasts')[['Amount']]
+
+    return [(render_table_orders, (weekly_orders, 'images/table_orders.png')),
+            (render_barplot_pizzas, (pizzas_sum, 'images/barplot_pizzas.png')),
+            (render_barplot_pizzas_sizes, (pizzas_sizes_sum, 'images/barplot_pizzas_sizes.png')),
+            (render_barplot_ingredients, (ingredients_sum, 'images/barplot_ingredients.png')),
+            (render_pie_categories, (pizza_categories, 'images/pie_categories.png')),
+            (render_pie_sizes, (pizza_sizes, len(pizza_categories) + 1, 'images/pie_sizes.png')),
+            (render_table, (prediction_df[:len(prediction_df) // 2], 'images/predictions_1.png')),
+            (render_table, (prediction_df[len(prediction_df) // 2:], 'images/predictions_2.png'))]
+
+
+def render_table_orders(weekly_orders: pd.DataFrame, path: str):
     amount_mean = weekly_orders['Amount_ordered'].mean()
 
     def higher_than_mean(value):
@@ -149,81 +253,68 @@ def create_visualizations():
         .set_properties(**{'border': '1.3px black'}) \
         .bar(subset=["Price", ], color='lightgreen') \
         .applymap(higher_than_mean, subset=['Amount_ordered'])
-    dfi.export(styled_df, 'images/table_orders.png', table_conversion='matplotlib')
+    dfi.export(styled_df, path, table_conversion='matplotlib')
 
-    # Setting seaborn style
-    sns.set_style('darkgrid')
 
-    # Generating barplot of pizzas
-    pizzas_sum = pizzas_weeks.sum(axis=0).to_frame(name="Amount")
-    pizzas_sum['Pizza'] = pizzas_sum.index
-    pizzas_sum.reset_index(inplace=True)
-    pizzas_sum.sort_values('Amount', ascending=False, inplace=True)
+def render_table(dataframe: pd.DataFrame, path: str):
+    dfi.export(dataframe, path, table_conversion='matplotlib')
+
 
-    fig = plt.figure(1, figsize=(20, 20))
+def render_barplot_pizzas(pizzas_sum: pd.DataFrame, path: str):
+    # Setting seaborn style
+    sns.set_style('darkgrid')
+    fig = plt.figure(figsize=(20, 20))
     sns.barplot(data=pizzas_sum, x='Amount', y='Pizza', palette=sns.cubehelix_palette(len(pizzas_sum)))
     plt.title('Pizzas ordered in a year in Maven Pizza', fontweight="bold", fontsize=20)
     plt.xlabel('Pizzas', fontsize=15)
     plt.ylabel('Amount ordered', fontsize=15)
     # Save the plot as a PNG
-    plt.savefig('images/barplot_pizzas.png', bbox_inches='tight', pad_inches=0)
-    # fig.show()
+    plt.savefig(path, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
 
-    # Generating barplot of pizzas with sizes
-    pizzas_sizes_sum = pizzas_weeks_sizes.sum(axis=0).to_frame(name="Amount")
-    pizzas_sizes_sum['Size'] = pizzas_sizes_sum.index
-    pizzas_sizes_sum.reset_index(inplace=True)
-    pizzas_sizes_sum.sort_values('Amount', ascending=False, inplace=True)
-    pizzas_sizes_sum['Pizza'] = pizzas_sizes_sum['Size'].apply(lambda pizza: pizza.rsplit('_', 1)[0])
-    pizzas_sizes_sum['Size'] = pizzas_sizes_sum['Size'].apply(lambda pizza: pizza.rsplit('_', 1)[1].upper())
 
-    fig = plt.figure(2, figsize=(20, 20))
+def render_barplot_pizzas_sizes(pizzas_sizes_sum: pd.DataFrame, path: str):
+    sns.set_style('darkgrid')
+    fig = plt.figure(figsize=(20, 20))
     sns.barplot(data=pizzas_sizes_sum, x='Amount', y='Pizza', hue='Size', palette=sns.cubehelix_palette(5))
     plt.title('Pizzas ordered in a year in Maven Pizza (separated by size)', fontweight="bold", fontsize=20)
     plt.xlabel('Pizzas', fontsize=15)
     plt.ylabel('Amount ordered', fontsize=15)
     # Save the plot as a PNG
-    plt.savefig('images/barplot_pizzas_sizes.png', bbox_inches='tight', pad_inches=0)
-    # fig.show()
+    plt.savefig(path, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
 
-    # Generate barplot of ingredients
-    ingredients_sum = ingredients_weeks.sum(axis=0)
-    ingredients_sum.index.name = 'Ingredients'
-    ingredients_sum.sort_values(ascending=False, inplace=True)
 
-    fig = plt.figure(3, figsize=(20, 20))
+def render_barplot_ingredients(ingredients_sum: pd.Series, path: str):
+    sns.set_style('darkgrid')
+    fig = plt.figure(figsize=(20, 20))
     sns.barplot(x=ingredients_sum.values, y=ingredients_sum.index, palette=sns.cubehelix_palette(len(ingredients_sum)))
     plt.title('Ingredients consumed in a year in Maven Pizza', fontweight="bold", fontsize=20)
     plt.xlabel('Ingredient', fontsize=15)
     plt.ylabel('Amount consumed', fontsize=15)
     # Save the plot as a PNG
-    plt.savefig('images/barplot_ingredients.png', bbox_inches='tight', pad_inches=0)
-    # fig.show()
+    plt.savefig(path, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
 
-    # Generate pie of pizza categories
-    pizza_categories = pizzas_weeks.sum(axis=0).to_frame(name="Amount")
-    pizza_categories['Pizza'] = pizza_categories.index
-    pizza_categories.reset_index(inplace=True)
 
-    def categorize(pizza):
-        return pizza_types[pizza_types['pizza_type_id'] == pizza]['category'].values[0]
-
-    pizza_categories['Category'] = pizza_categories['Pizza'].apply(categorize)
-    pizza_categories = pizza_categories.groupby("Category")['Amount'].sum()
-    fig = plt.figure(4, figsize=(10, 10))
+def render_pie_categories(pizza_categories: pd.Series, path: str):
+    sns.set_style('darkgrid')
+    fig = plt.figure(figsize=(10, 10))
     explode = (0, 0.05, 0, 0)
     plt.pie(pizza_categories.values, explode=explode, labels=pizza_categories.index, autopct='%1.1f%%', startangle=90,
             colors=sns.cubehelix_palette(len(pizza_categories) + 1), wedgeprops={'linewidth': 3.0},
             textprops={'size': 'x-large'})
     plt.title('Amount of pizzas ordered in a year by Category', fontweight="bold", fontsize=20)
-    plt.savefig('images/pie_categories.png', bbox_inches='tight', pad_inches=0)
-    # fig.show()
+    plt.savefig(path, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
 
-    pizza_sizes = pizzas_sizes_sum.groupby("Size")['Amount'].sum()
+
+def render_pie_sizes(pizza_sizes: pd.Series, n_colors: int, path: str):
+    sns.set_style('darkgrid')
     fig, ax = plt.subplots(figsize=(10, 5), subplot_kw=dict(aspect="equal"))
 
     wedges, texts = ax.pie(pizza_sizes.values, wedgeprops=dict(width=0.5), startangle=-40,
-                           colors=sns.cubehelix_palette(len(pizza_categories) + 1))
+                           colors=sns.cubehelix_palette(n_colors))
 
     kw = dict(arrowprops=dict(arrowstyle="-", color='black', linewidth=2), zorder=0, va="center")
     for p, label in zip(wedges, list(map(lambda size: size + f' ({pizza_sizes[size]} pizzas)', pizza_sizes.index))):
@@ -236,9 +327,5 @@ def create_visualizations():
         ax.annotate(label, xy=(x, y), xytext=(1.35 * np.sign(x), 1.4 * y),
                     horizontalalignment=horizontalalignment, fontsize=15, **kw)
     plt.title('Amount of pizzas ordered in a year by Size', fontweight="bold", fontsize=20)
-    plt.savefig('images/pie_sizes.png', bbox_inches='tight', pad_inches=0)
-    # fig.show()
-
-    prediction_df = ingredients_weeks[ingredients_weeks.columns].median().to_frame(name="Amount")
-    dfi.export(prediction_df[:len(prediction_df) // 2], 'images/predictions_1.png', table_conversion='matplotlib')
-    dfi.export(prediction_df[len(prediction_df) // 2:], 'images/predictions_2.png', table_conversion='matplotlib')
+    plt.savefig(path, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
@@ -0,0 +1,346 @@
+import argparse
+import inspect
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import cube
+import recipes
+import store
+
+# Local service answering queries over the processed data (weekly pizzas, ingredients, forecasts, revenue...) as json,
+# without running main.py again. The stored frames are loaded once, and every answer is kept, already encoded, in a
+# least recently used cache. Both are dropped as soon as a file of the store changes, i.e. when new data is ingested.
+HOST = '127.0.0.1'
+PORT = 8765
+CACHE_ENTRIES = 1024
+PIZZA_TYPES_PATH = 'data/pizza_types.csv'
+FORECASTS = {'ingredients': 'forecasts', 'pizzas': 'pizza_forecasts', 'weekday': 'weekday_forecasts'}
+WEEKLY_PIZZAS = {'type': 'pizzas_weeks_types', 'size': 'pizzas_weeks_sizes'}
+CUBES = {'orders': 'cube_orders', 'pizzas': 'cube_pizzas'}
+
+
+class QueryError(ValueError):
+    # Bad parameters of a query, answered with a 400
+    pass
+
+
+class Cache:
+    # Encoded answers by query, the least recently used one evicted beyond max_entries
+    def __init__(self, max_entries: int = CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[tuple, bytes]' = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value: bytes) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+def store_version() -> tuple:
+    # Name, size and modification time of every stored file (and of the recipes): any write to the store changes it
+    try:
+        entries = [(entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                   for entry in os.scandir(store.STORE_DIRECTORY) if entry.is_file()]
+    except FileNotFoundError:
+        entries = []
+    try:
+        recipes = os.stat(PIZZA_TYPES_PATH)
+        entries.append((PIZZA_TYPES_PATH, recipes.st_size, recipes.st_mtime_ns))
+    except FileNotFoundError:
+        pass
+    return tuple(sorted(entries))
+
+
+class Service:
+    # The stored frames, loaded once for as long as the store does not change, and the cache of answers over them
+    def __init__(self, cache_entries: int = CACHE_ENTRIES):
+        self.cache = Cache(cache_entries)
+        self.frames: Dict[str, object] = {}
+        self.version = store_version()
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        # A stat of the store directory per query, so new data is seen by the very next one
+        version = store_version()
+        if version != self.version:
+            with self.lock:
+                self.frames, self.version = {}, version
+                self.cache.clear()
+                self.reloads += 1
+
+    def frame(self, name: str):
+        with self.lock:
+            if name not in self.frames:
+                if name == 'pizza_types':
+                    self.frames[name] = pd.read_csv(PIZZA_TYPES_PATH, delimiter=',', encoding='latin')
+                else:
+                    self.frames[name] = store.load(name)
+            return self.frames[name]
+
+    def warm(self, names: List[str]) -> List[str]:
+        # Loads the frames that are already in the store, so the first queries do not wait for them
+        loaded = []
+        for name in names:
+            try:
+                self.frame(name)
+                loaded.append(name)
+            except FileNotFoundError:
+                pass
+        return loaded
+
+    def answer(self, path: str, parameters: Dict[str, str]) -> bytes:
+        self.refresh()
+        version = self.version
+        key = (path, tuple(sorted(parameters.items())))
+        value = self.cache.get(key)
+        if value is None:
+            try:
+                inspect.signature(QUERIES[path]).bind(self, **parameters)
+            except TypeError as error:
+                raise QueryError(f"Unknown parameter(s) for {path}: {error}") from error
+            value = encode(QUERIES[path](self, **parameters))
+            # Not kept if the store changed while it was computed
+            if version == self.version:
+                self.cache.put(key, value)
+        return value
+
+    def status(self) -> dict:
+        return {'frames': sorted(self.frames), 'cached': len(self.cache.entries), 'hits': self.cache.hits,
+                'misses': self.cache.misses, 'reloads': self.reloads,
+                'store_files': len([entry for entry in self.version if entry[0] != PIZZA_TYPES_PATH])}
+
+
+def encode(result) -> bytes:
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.to_json(orient='split', date_format='iso').encode()
+    # numpy scalars, e.g. a rollup without keys
+    return json.dumps(result.item() if hasattr(result, 'item') else result).encode()
+
+
+def choice(value: str, options: Dict[str, str], parameter: str) -> str:
+    if value not in options:
+        raise QueryError(f"Unknown {parameter} '{value}', expected one of {', '.join(options)}")
+    return options[value]
+
+
+def weeks(table: pd.DataFrame, start: Optional[str], end: Optional[str]) -> pd.DataFrame:
+    # Rows of the weekly tables are labelled by week of the year, '00' to '52'
+    labels = table.index.astype(str)
+    keep = (labels >= (start or '').zfill(2)) & (labels <= (end or '99').zfill(2))
+    return table[keep]
+
+
+def columns(table: pd.DataFrame, names: Optional[str]) -> pd.DataFrame:
+    if names is None:
+        return table
+    names = names.split(',')
+    unknown = [name for name in names if name not in table.columns]
+    if unknown:
+        raise QueryError(f"Unknown column(s) {', '.join(unknown)}")
+    return table[names]
+
+
+def cube_query(service: Service, table: str, time: Optional[str], by: Optional[str], measure: str,
+               start: Optional[str], end: Optional[str]):
+    frame = service.frame(table)
+    keys = [column for column in cube.PIZZA_KEYS if column in frame.columns]
+    if by is not None and by not in keys:
+        raise QueryError(f"Unknown key '{by}', expected one of {', '.join(keys)}")
+    measures = measure.split(',')
+    unknown = [name for name in measures if name not in frame.columns or name in ['day', 'hour'] + keys]
+    if unknown:
+        raise QueryError(f"Unknown measure(s) {', '.join(unknown)}")
+    try:
+        return cube.query(frame, time.split(',') if time else None, by,
+                          measures[0] if len(measures) == 1 else measures, start, end)
+    except ValueError as error:
+        raise QueryError(str(error)) from error
+
+
+# Queries, by path. Parameters come from the query string, e.g. /revenue?by=category&time=month&start=2015-06-01
+def query_weekly_pizzas(service: Service, by: str = 'type', start: str = None, end: str = None,
+                        pizzas: str = None) -> pd.DataFrame:
+    # Pizzas sold every week, by pizza type or by pizza (type and size), for the weeks between start and end
+    return columns(weeks(service.frame(choice(by, WEEKLY_PIZZAS, 'by')), start, end), pizzas)
+
+
+def query_ingredients(service: Service, time: str = None, start: str = None, end: str = None,
+                      ingredients: str = None):
+    # Ingredients used between two dates (any date pandas can parse), in total or by time key(s)
+    try:
+        table = cube.ingredients(service.frame('cube_pizzas'), service.frame('pizza_types'),
+                                 time.split(',') if time else 'year', start, end)
+    except ValueError as error:
+        raise QueryError(str(error)) from error
+    # Every ingredient of the recipes, even if none was used in those dates
+    names = recipes.recipe_matrix(service.frame('pizza_types'))[2]
+    table = columns(table.reindex(columns=names, fill_value=0), ingredients)
+    return table if time else table.sum()
+
+
+def query_forecasts(service: Service, of: str = 'ingredients', items: str = None,
+                    column: str = None) -> pd.DataFrame:
+    # Next week forecasts of the ingredients, of the pizza types, or of the ingredients by day of the week
+    forecasts = service.frame(choice(of, FORECASTS, 'of'))
+    if of == 'weekday':
+        return columns(forecasts, items)
+    if items is not None:
+        unknown = [item for item in items.split(',') if item not in forecasts.index]
+        if unknown:
+            raise QueryError(f"Unknown item(s) {', '.join(unknown)}")
+        forecasts = forecasts.loc[items.split(',')]
+    return columns(forecasts, column or 'Amount')
+
+
+def query_revenue(service: Service, by: str = 'category', time: str = None, start: str = None,
+                  end: str = None):
+    # Revenue by pizza key (category, pizza_type_id, size or pizza_id), optionally by time key(s) as well
+    return cube_query(service, 'cube_pizzas', time, by, 'revenue', start, end)
+
+
+def query_cube(service: Service, table: str = 'pizzas', time: str = None, by: str = None,
+               measure: str = 'pizzas', start: str = None, end: str = None):
+    # Any rollup of the cubes (see cube.query), e.g. /cube?table=orders&time=weekday,hour&measure=orders
+    return cube_query(service, choice(table, CUBES, 'table'), time, by, measure, start, end)
+
+
+QUERIES: Dict[str, Callable] = {
+    '/weekly_pizzas': query_weekly_pizzas,
+    '/ingredients': query_ingredients,
+    '/forecasts': query_forecasts,
+    '/revenue': query_revenue,
+    '/cube': query_cube,
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    service: Service = None
+    verbose = False
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parameters = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/') or '/'
+        try:
+            if path == '/status':
+                self.service.refresh()
+                self.respond(200, encode(self.service.status()))
+            elif path not in QUERIES:
+                self.respond(404, encode({'error': f"Unknown query '{path}'",
+                                          'queries': ['/status'] + list(QUERIES)}))
+            else:
+                self.respond(200, self.service.answer(path, parameters))
+        except QueryError as error:
+            self.respond(400, encode({'error': str(error)}))
+        except FileNotFoundError as error:
+            self.respond(503, encode({'error': str(error)}))
+        except Exception as error:
+            # e.g. a file of the store read while main.py was still writing it
+            self.respond(503, encode({'error': f"{type(error).__name__}: {error}"}))
+
+    def respond(self, code: int, body: bytes) -> None:
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format: str, *arguments) -> None:
+        # Dashboards poll all the time, so requests are only logged when asked to
+        if self.verbose:
+            super().log_message(format, *arguments)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self) -> None:
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service: Service, host: str = HOST, port: int = PORT, unix_socket: Optional[str] = None,
+                verbose: bool = False) -> ThreadingHTTPServer:
+    handler = type('ServiceHandler', (Handler,), {'service': service, 'verbose': verbose})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def address(server: ThreadingHTTPServer) -> str:
+    if isinstance(server, UnixHTTPServer):
+        return f"unix socket {server.server_address}"
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Serve queries over the processed data of main.py as json")
+    parser.add_argument('--host', default=HOST, help="address to listen on (localhost by default)")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--socket', dest='unix_socket', default=None, metavar='PATH',
+                        help="listen on this unix socket instead of a port")
+    parser.add_argument('--cache-entries', type=int, default=CACHE_ENTRIES, help="answers kept in the cache")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    arguments = parser.parse_args(argv)
+
+    service = Service(arguments.cache_entries)
+    loaded = service.warm(list(CUBES.values()) + list(WEEKLY_PIZZAS.values()) + list(FORECASTS.values()) +
+                          ['pizza_types'])
+    print(f"Loaded {', '.join(loaded) or 'nothing yet (run main.py first)'}")
+    server = make_server(service, arguments.host, arguments.port, arguments.unix_socket, arguments.verbose)
+    print(f"Serving {', '.join(['/status'] + list(QUERIES))} on {address(server)}", flush=True)
+    # Stopped like with ctrl+c, so the socket file is removed as well
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if arguments.unix_socket is not None and os.path.exists(arguments.unix_socket):
+            os.remove(arguments.unix_socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import contextlib
+import glob
+import os
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+
+import instrumentation
+import outputs
+
+# Intermediate results shared by main, report and excel. They are pickled, so dtypes, categoricals, datetimes and
+# indexes come back as they were saved, without any parsing.
+STORE_DIRECTORY = 'processed_data/store'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Optional csv exports of the stored frames
+CSV_EXPORTS = {
+    'clean_dataframe': ("processed_data/clean_dataframe.csv", {}),
+    'order_lines': ("processed_data/order_lines.csv", {'index': False}),
+    'pizzas_weeks_types': ("processed_data/pizzas_weeks(with types_only).csv", {}),
+    'pizzas_weeks_sizes': ("processed_data/pizzas_weeks(with sizes).csv", {}),
+    'ingredients_weeks': ("processed_data/ingredients_weeks.csv", {}),
+    'forecasts': ("processed_data/ingredients_forecasts.csv", {}),
+    'pizza_forecasts': ("processed_data/pizza_forecasts.csv", {}),
+    'weekday_forecasts': ("processed_data/ingredients_weekday_forecasts.csv", {}),
+    'stores_pizzas_weeks_types': ("processed_data/stores_pizzas_weeks(with types_only).csv", {}),
+    'stores_pizzas_weeks_sizes': ("processed_data/stores_pizzas_weeks(with sizes).csv", {}),
+    'stores_ingredients_weeks': ("processed_data/stores_ingredients_weeks.csv", {}),
+    'chain_pizzas_weeks_types': ("processed_data/chain_pizzas_weeks(with types_only).csv", {}),
+    'chain_pizzas_weeks_sizes': ("processed_data/chain_pizzas_weeks(with sizes).csv", {}),
+    'chain_ingredients_weeks': ("processed_data/chain_ingredients_weeks.csv", {}),
+    'chain_forecasts': ("processed_data/chain_forecasts.csv", {}),
+}
+
+# Exports being built part by part inside appending(): name -> temporary file (None until the first part)
+pending: Dict[str, Optional[str]] = {}
+
+
+def path(name: str, part: int = None) -> str:
+    return os.path.join(STORE_DIRECTORY, f'{name}.pkl' if part is None else f'{name}.{part:06d}.pkl')
+
+
+def pattern(name: str) -> str:
+    # Matches the frame whether it is stored whole or in parts
+    return os.path.join(STORE_DIRECTORY, f'{name}.*pkl')
+
+
+def clear(name: str) -> None:
+    for file_name in glob.glob(os.path.join(STORE_DIRECTORY, f'{name}.pkl')) + \
+            glob.glob(os.path.join(STORE_DIRECTORY, f'{name}.*.pkl')):
+        os.remove(file_name)
+
+
+def export(frame: pd.DataFrame, name: str) -> None:
+    csv_path, options = CSV_EXPORTS[name]
+    with outputs.atomic(csv_path, newline='') as file:
+        frame.to_csv(file, sep=',', date_format=DATE_FORMAT, **options)
+
+
+def save(name: str, frame: pd.DataFrame, csv: bool = False, compression: str = None) -> None:
+    os.makedirs(STORE_DIRECTORY, exist_ok=True)
+    # Stored as plain pandas objects, so reading them back does not need to import main
+    frame = pd.Series(frame) if isinstance(frame, pd.Series) else pd.DataFrame(frame)
+    # Parts of a previous version are removed first: a reader may miss the frame for a moment, but never gets the
+    # new one mixed with them. A previous whole frame is just replaced
+    for file_name in glob.glob(os.path.join(STORE_DIRECTORY, f'{name}.*.pkl')):
+        os.remove(file_name)
+    with outputs.atomic_path(path(name)) as temporary:
+        frame.to_pickle(temporary, compression=compression, protocol=5)
+    instrumentation.rows_written(frame)
+    if csv and name in CSV_EXPORTS:
+        # The pickle is what the other stages read, the csv export can be written in the background
+        outputs.write(export, frame, name)
+
+
+def files(name: str) -> List[str]:
+    whole = [path(name)] if os.path.exists(path(name)) else []
+    return whole + sorted(glob.glob(os.path.join(STORE_DIRECTORY, f'{name}.*.pkl')))
+
+
+def parts(name: str) -> Iterator[pd.DataFrame]:
+    # The stored parts of a frame one by one, for what can be computed part by part
+    for file_name in files(name):
+        part = pd.read_pickle(file_name)
+        instrumentation.rows_read(part)
+        yield part
+
+
+def next_part(name: str) -> int:
+    return len(files(name))
+
+
+def add_rows(frame: pd.DataFrame, name: str, temporary: str) -> None:
+    # Rows at the end of an export being built, after the header if it is still empty
+    _, options = CSV_EXPORTS[name]
+    frame.to_csv(temporary, sep=',', date_format=DATE_FORMAT, mode='a', header=os.path.getsize(temporary) == 0,
+                 **options)
+
+
+def start_export(name: str, stored: List[str], temporary: str, compression: str = None) -> None:
+    # Export being built with the rows of the parts already stored: a copy of the current export when it has them all
+    # (it was written after the last one), else they are exported again, e.g. after a run without csv exports
+    csv_path, _ = CSV_EXPORTS[name]
+    if stored and os.path.exists(csv_path) and os.path.getmtime(csv_path) >= os.path.getmtime(stored[-1]):
+        outputs.copy(csv_path, temporary)
+        return
+    open(temporary, 'w').close()
+    for file_name in stored:
+        add_rows(pd.read_pickle(file_name, compression=compression), name, temporary)
+
+
+@contextlib.contextmanager
+def appending(*names: str) -> Iterator[None]:
+    # The csv exports of the parts appended in the block are built in temporary files, which replace the exports when
+    # it ends (and are removed if it fails), so nobody reading them ever gets only some of the parts
+    pending.update(dict.fromkeys(names))
+    try:
+        yield
+        for name in names:
+            if pending[name] is not None:
+                os.replace(pending[name], CSV_EXPORTS[name][0])
+                pending[name] = None
+    finally:
+        for name in names:
+            temporary = pending.pop(name)
+            if temporary is not None and os.path.exists(temporary):
+                os.remove(temporary)
+
+
+def append(name: str, frame: pd.DataFrame, part: int = None, csv: bool = False, compression: str = None) -> None:
+    # Frames too big to be held at once, or growing between runs, are stored in parts (part 0 starts a new frame,
+    # and by default the rows are added after the ones already stored)
+    os.makedirs(STORE_DIRECTORY, exist_ok=True)
+    if part is None:
+        part = next_part(name)
+    if part == 0:
+        clear(name)
+    stored = files(name)
+    with outputs.atomic_path(path(name, part)) as temporary:
+        pd.DataFrame(frame).to_pickle(temporary, compression=compression, protocol=5)
+    instrumentation.rows_written(frame)
+    if not csv or name not in CSV_EXPORTS:
+        return
+    # Appended in order, part by part, so not in the background
+    if name not in pending:
+        with outputs.atomic_path(CSV_EXPORTS[name][0]) as temporary:
+            start_export(name, stored, temporary, compression)
+            add_rows(frame, name, temporary)
+        return
+    if pending[name] is None:
+        pending[name] = outputs.temporary_path(CSV_EXPORTS[name][0])
+        start_export(name, stored, pending[name], compression)
+    add_rows(frame, name, pending[name])
+
+
+def load(name: str, compression: str = None) -> pd.DataFrame:
+    parts = [pd.read_pickle(file_name, compression=compression) for file_name in files(name)]
+    if not parts:
+        raise FileNotFoundError(f"'{name}' is not in {STORE_DIRECTORY}, run main.py first")
+    instrumentation.rows_read(parts)
+    if len(parts) == 1:
+        return parts[0]
+    frame = pd.concat(parts, ignore_index=isinstance(parts[0].index, pd.RangeIndex))
+    # Parts may have different categories: the concatenated column falls back to object, so it is re-encoded
+    for column, dtype in parts[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype('category')
+    return frame
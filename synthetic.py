@@ -0,0 +1,155 @@
+import argparse
+import os
+import shutil
+import sys
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Synthetic orders.csv and order_details.csv as dirty as the real ones (same date/time formats, pizza id typos and
+# separators, spelled out or negative quantities, missing values, rows out of order), for any number of order lines.
+# They are written in chunks of orders, so the size is only limited by the disk. The menu (pizzas.csv,
+# pizza_types.csv) and the data dictionary are copied from data/.
+MENU_FILES = ['pizzas.csv', 'pizza_types.csv', 'data_dictionary.csv']
+CHUNK_ORDERS = 200000
+
+# Shares measured on the original files
+MISSING = {'date': 0.11, 'time': 0.095, 'pizza_id': 0.117, 'quantity': 0.097}
+DATE_FORMATS = ['%Y-%m-%d', '%b %d %Y', '%a %d-%b-%Y', '%A,%d %B, %Y', '%d-%m-%y %H:%M:%S', 'epoch']
+TIME_FORMATS = ['%H:%M:%S', '%H:%M %p', '%HH %MM %SS']
+# Typos replace some letters of a pizza id, and the underscores may be written as dashes or spaces
+TYPOS = [('a', '@', 0.05), ('o', '0', 0.02), ('e', '3', 0.02)]
+SEPARATORS = ['_', '-', ' ']
+SEPARATOR_SHARES = [0.68, 0.23, 0.09]
+# Values of the quantity column, and how many rows had each one
+QUANTITIES = ['1', 'one', 'One', '-1', '2', 'two', '-2', '3', '4']
+QUANTITY_ROWS = np.array([34598, 5220, 1866, 1372, 772, 14, 30, 19, 3], dtype=float)
+# Pizzas per order: 1 + Poisson(mean), and orders by hour of the day (the shop opens from 9 to 23)
+EXTRA_LINES_PER_ORDER = 1.28
+HOUR_SHARES = np.array([1, 1, 20, 60, 110, 95, 60, 50, 60, 80, 80, 70, 55, 30, 10], dtype=float)
+OPENING_HOUR = 9
+
+
+def formatted(values: pd.Series, date_format: str) -> np.ndarray:
+    # Only the distinct values are formatted
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques)
+    if date_format == 'epoch':
+        # Seconds since 1970 of the day, as a float
+        text = (uniques.dt.normalize().astype(np.int64) // 10 ** 9).astype(str) + '.0'
+    else:
+        text = uniques.dt.strftime(date_format)
+    return text.to_numpy(dtype=object)[codes]
+
+
+def with_formats(values: pd.Series, formats: List[str], random: np.random.Generator, missing: float) -> np.ndarray:
+    # Every value written in one of the formats, or left empty
+    result = np.empty(len(values), dtype=object)
+    choice = random.integers(len(formats), size=len(values))
+    for position, date_format in enumerate(formats):
+        rows = np.flatnonzero(choice == position)
+        result[rows] = formatted(values.iloc[rows], date_format)
+    result[random.random(len(values)) < missing] = None
+    return result
+
+
+def dirty_pizza_ids(pizza_ids: pd.Index, rows: np.ndarray, random: np.random.Generator) -> np.ndarray:
+    # Pizza of every line with a random separator and typos. Each (pizza, variant) is only built once
+    variant = random.choice(len(SEPARATORS), size=len(rows), p=SEPARATOR_SHARES)
+    for bit, (_, _, share) in enumerate(TYPOS):
+        variant = variant + (random.random(len(rows)) < share) * (len(SEPARATORS) << bit)
+    codes, uniques = pd.factorize(rows * (len(SEPARATORS) << len(TYPOS)) + variant)
+    names = []
+    for unique in uniques:
+        pizza, variant = divmod(int(unique), len(SEPARATORS) << len(TYPOS))
+        name = pizza_ids[pizza].replace('_', SEPARATORS[variant % len(SEPARATORS)])
+        for bit, (letter, typo, _) in enumerate(TYPOS):
+            if variant // len(SEPARATORS) >> bit & 1:
+                name = name.replace(letter, typo)
+        names.append(name)
+    result = np.asarray(names, dtype=object)[codes]
+    result[random.random(len(rows)) < MISSING['pizza_id']] = None
+    return result
+
+
+def popularity(pizzas: int, random: np.random.Generator) -> np.ndarray:
+    # Some pizzas sell much more than others
+    weights = 1 / np.arange(1, pizzas + 1) ** 0.8
+    return random.permutation(weights / weights.sum())
+
+
+def generate(directory: str, lines: int, seed: int = 0, start: str = '2016-01-01', end: str = '2016-12-31',
+             menu_directory: str = 'data', chunk_orders: int = CHUNK_ORDERS) -> dict:
+    # Writes directory/data/ with about this many order lines between start and end. Returns what was written
+    random = np.random.default_rng(seed)
+    data_directory = os.path.join(directory, 'data')
+    os.makedirs(data_directory, exist_ok=True)
+    for file_name in MENU_FILES:
+        shutil.copyfile(os.path.join(menu_directory, file_name), os.path.join(data_directory, file_name))
+    pizza_ids = pd.Index(pd.read_csv(os.path.join(menu_directory, 'pizzas.csv'))['pizza_id'])
+    shares = popularity(len(pizza_ids), random)
+    first_day, days = pd.Timestamp(start), (pd.Timestamp(end) - pd.Timestamp(start)).days + 1
+    orders_path = os.path.join(data_directory, 'orders.csv')
+    details_path = os.path.join(data_directory, 'order_details.csv')
+    pd.DataFrame(columns=['order_id', 'date', 'time']).to_csv(orders_path, sep=';', index=False, lineterminator='\r\n')
+    pd.DataFrame(columns=['order_details_id', 'order_id', 'pizza_id', 'quantity']).to_csv(
+        details_path, sep=';', index=False, lineterminator='\r\n')
+
+    written_orders, written_lines = 0, 0
+    while written_lines < lines:
+        # Enough orders for the remaining lines, in order of time
+        count = min(chunk_orders, max(1, int((lines - written_lines) / (1 + EXTRA_LINES_PER_ORDER)) + 1))
+        order_ids = np.arange(written_orders + 1, written_orders + count + 1)
+        # The days of the chunk follow the ones of the previous chunk, so order ids go in order of time
+        first = days * written_lines / lines
+        last = days * min(1.0, (written_lines + count * (1 + EXTRA_LINES_PER_ORDER)) / lines)
+        seconds = np.sort((first + random.random(count) * (last - first)).astype(np.int64) * 86400 +
+                          (OPENING_HOUR + random.choice(len(HOUR_SHARES), size=count,
+                                                        p=HOUR_SHARES / HOUR_SHARES.sum())) * 3600 +
+                          random.integers(3600, size=count))
+        timestamps = pd.Series(first_day + pd.to_timedelta(seconds, unit='s'))
+        order_lines = np.minimum(1 + random.poisson(EXTRA_LINES_PER_ORDER, size=count), lines - written_lines)
+        order_lines = order_lines[:np.searchsorted(np.cumsum(order_lines), lines - written_lines, side='left') + 1]
+        # The last order of the file only gets the lines left
+        order_lines[-1] -= max(0, written_lines + order_lines.sum() - lines)
+        count = len(order_lines)
+        order_ids, timestamps = order_ids[:count], timestamps.iloc[:count]
+
+        orders = pd.DataFrame({'order_id': order_ids,
+                               'date': with_formats(timestamps, DATE_FORMATS, random, MISSING['date']),
+                               'time': with_formats(timestamps, TIME_FORMATS, random, MISSING['time'])})
+        line_orders = np.repeat(order_ids, order_lines)
+        pizzas = random.choice(len(pizza_ids), size=len(line_orders), p=shares)
+        quantities = np.asarray(QUANTITIES, dtype=object)[random.choice(len(QUANTITIES), size=len(line_orders),
+                                                                        p=QUANTITY_ROWS / QUANTITY_ROWS.sum())]
+        quantities[random.random(len(line_orders)) < MISSING['quantity']] = None
+        details = pd.DataFrame({'order_details_id': np.arange(written_lines + 1, written_lines + len(line_orders) + 1),
+                                'order_id': line_orders, 'pizza_id': dirty_pizza_ids(pizza_ids, pizzas, random),
+                                'quantity': quantities})
+
+        # Rows come shuffled, like in the original files
+        orders.iloc[random.permutation(len(orders))].to_csv(orders_path, sep=';', index=False, header=False,
+                                                            mode='a', lineterminator='\r\n')
+        details.iloc[random.permutation(len(details))].to_csv(details_path, sep=';', index=False, header=False,
+                                                              mode='a', lineterminator='\r\n')
+        written_orders += count
+        written_lines += len(line_orders)
+    return {'directory': data_directory, 'orders': written_orders, 'lines': written_lines, 'seed': seed}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Synthetic Maven Pizza order files, as dirty as the real ones")
+    parser.add_argument('directory', help="where to write data/ (orders.csv, order_details.csv and the menu)")
+    parser.add_argument('--lines', type=int, default=48620, help="order lines to generate")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--start', default='2016-01-01', help="first day of the orders")
+    parser.add_argument('--end', default='2016-12-31', help="last day of the orders")
+    arguments = parser.parse_args(argv)
+    result = generate(arguments.directory, arguments.lines, arguments.seed, arguments.start, arguments.end)
+    print(f"{result['lines']} order lines in {result['orders']} orders written to {result['directory']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())